@@ -0,0 +1,23 @@
+# This file replaces files atomically: readers see either the old content or the new one, never half a file, and a crash
+# while writing leaves the old file in place.
+
+import os
+import threading
+
+def write_atomic(path, content, sync=False):
+    'Replaces the file at path with content (str or bytes). With sync, the content is on disk before it replaces the old file.'
+    # Next to path, so that os.replace stays on one file system, and of our own, so that concurrent writers don't mix their content
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb' if isinstance(content, (bytes, bytearray)) else 'w') as f:
+            f.write(content)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,125 @@
+# This file runs scripted chat sessions without a user, e.g. questionnaires collected offline.
+# A script is the list of answers a user would type, like Demo1.txt. Scripts run in parallel in a process pool.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from data_store import open_store
+from group_writer import GroupWriter, QueueStore, fsync_policies
+from run import Session, data_file, run_session
+from session_log import get_logger
+
+session_queue = None # In worker processes: queue to the GroupWriter of the parent process
+
+# Workers are not forked from this process: a fork copies the locks the writer thread holds at that moment, e.g. of the queue
+mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+class ScriptChannel:
+    'Answers with the lines of a script, and ignores what the bot says (it is in the chat log anyway)'
+    def __init__(self, answers):
+        self.answers = iter(answers)
+        self.last_prompt = None
+
+    async def input(self, prompt_str):
+        self.last_prompt = prompt_str
+        try:
+            return next(self.answers)
+        except StopIteration: # Same as stdin running out
+            raise EOFError
+
+    def output(self, output_str):
+        pass
+
+def read_scripts(path):
+    'Yields (script id, answers) for a directory of scripts (one answer per line) or a jsonl file with one script per line'
+    if os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            if file_name.startswith('.') or not os.path.isfile(os.path.join(path, file_name)):
+                continue
+            with open(os.path.join(path, file_name)) as f:
+                yield os.path.splitext(file_name)[0], f.read().splitlines()
+    else:
+        with open(path) as f:
+            for i_line, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                script = json.loads(line)
+                if isinstance(script, list): # Only the answers
+                    yield f'{i_line}', script
+                else:
+                    yield str(script.get('id', i_line)), script['answers']
+
+def init_worker(queue):
+    global session_queue
+    session_queue = queue
+
+def run_script(script_id, answers, log_dir, data_path):
+    'Runs a scripted session, its data goes to the queue of the parent process. Returns (script id, error), with error None if the session got to its end.'
+    log_file = os.path.join(log_dir, os.path.basename(script_id) + '.log')
+    open(log_file, 'w').close() # Start a fresh log when a script is run again
+    channel = ScriptChannel(answers)
+    session = Session(channel, log_file)
+    try:
+        asyncio.run(run_session(session, QueueStore(session_queue, data_path), checkpoint=False))
+    except EOFError:
+        get_logger(log_file).close()
+        return script_id, f'Ran out of answers at: {channel.last_prompt.strip()}'
+    except Exception:
+        get_logger(log_file).close()
+        return script_id, traceback.format_exc()
+    return script_id, None
+
+def run_batch(scripts, data_store, log_dir, workers=None, fsync='interval'):
+    'Runs scripts in a process pool and group-commits their data to data_store. Returns the number of sessions, the list of failures and commit statistics.'
+    os.makedirs(log_dir, exist_ok=True)
+    script_ids, answers = [], []
+    for script_id, script_answers in scripts:
+        script_ids.append(script_id)
+        answers.append(script_answers)
+
+    n_done, failures = 0, []
+    workers = workers or os.cpu_count() or 1
+    n = len(script_ids)
+    queue = mp_context.Queue()
+    writer = GroupWriter(data_store, queue, fsync=fsync)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_worker, initargs=(queue,)) as executor:
+            results = executor.map(run_script, script_ids, answers, [log_dir] * n, [data_store.path] * n, chunksize=max(1, n // (4 * workers)))
+            for script_id, error in results:
+                if error is not None:
+                    failures.append({'id': script_id, 'log_file': os.path.join(log_dir, os.path.basename(script_id) + '.log'), 'error': error})
+                else:
+                    n_done += 1
+        # The workers have exited, so everything they queued is in the queue, ahead of the writer's stop signal
+    finally:
+        writer.close()
+    return n_done, failures, writer.stats()
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs scripted sessions in parallel: a directory with one script per file (one answer per line, like Demo1.txt), or a jsonl file with one script per line ({"id": ..., "answers": [...]})')
+    parser.add_argument('scripts', help='Directory or jsonl file of scripts')
+    parser.add_argument('--data-file', default=data_file, help='Where to store the collected data, either .jsonl or a sqlite database (.db)')
+    parser.add_argument('--log-dir', default='batch_logs', help='Where to write the chat log of every script')
+    parser.add_argument('--failures', default='failures.jsonl', help='Where to write the report of scripts that did not finish')
+    parser.add_argument('--workers', type=int, help='Number of processes (default: number of CPUs)')
+    parser.add_argument('--fsync', choices=fsync_policies, default='interval', help='When to sync the collected data to disk: after every group of sessions, at most every second, or when the OS decides (default: interval)')
+    args = parser.parse_args()
+
+    n_done, failures, stats = run_batch(read_scripts(args.scripts), open_store(args.data_file, args.fsync), args.log_dir, args.workers, args.fsync)
+    with open(args.failures, 'w') as f:
+        for failure in failures:
+            f.write(json.dumps(failure) + '\n')
+
+    print(f"Saved {n_done} sessions to {args.data_file}, chat logs are in {args.log_dir}")
+    if stats['commits']:
+        print(f"{stats['commits']} commits, {stats['sessions_per_commit']:.1f} sessions per commit, commit latency avg {stats['avg_commit_ms']:.2f} ms max {stats['max_commit_ms']:.2f} ms")
+    if failures:
+        print(f"{len(failures)} scripts failed, see {args.failures}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+# This file holds what the benchmarks share. It imports nothing of the bot, so that importing it costs nothing.
+
+def add_typo(rng, s):
+    'Changes, drops or doubles one letter of s'
+    i = rng.randrange(len(s))
+    kind = rng.randrange(3)
+    if kind == 0:
+        return s[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + s[i+1:]
+    elif kind == 1:
+        return s[:i] + s[i+1:]
+    return s[:i] + s[i] + s[i:]
@@ -0,0 +1,177 @@
+# This file benchmarks the hot functions of trucks_nlp over catalogs of different sizes (the real brands plus
+# synthetic ones), utterance lengths and typo densities. Results can be stored as a baseline, and later runs
+# checked against it, failing if a metric got slower than allowed.
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import trucks_nlp
+from bench_common import add_typo
+from trucks_nlp import BrandIndex, blandify_str, find_brand, fuzzy_match, get_brands, sanitize_float, sanitize_int
+
+catalog_sizes = [400, 10000, 100000]
+utterance_lengths = [3, 12, 40]     # Words
+typo_densities = [0.0, 0.5]         # Share of mentioned brands with a typo
+n_repeats = 5                       # Best of this many runs is reported
+
+syllables = ['ka', 'ro', 'mi', 'te', 'lu', 'sa', 'vo', 'ne', 'di', 'gra', 'tor', 'vex', 'lan', 'bri', 'sco', 'mer', 'dal', 'zen', 'pho', 'ix']
+filler_words = ['we', 'have', 'some', 'trucks', 'of', 'and', 'a', 'few', 'mostly', 'i', 'think', 'also', 'the', 'old', 'new', 'plus']
+
+def synthetic_catalog(size, rng):
+    'Returns the real brands, topped up with made up brand names to size'
+    catalog = get_brands('brands.txt')[:size]
+    known = set(blandify_str(b) for b in catalog)
+    while len(catalog) < size:
+        name = ''.join(rng.choice(syllables) for i in range(rng.randint(2, 4))).capitalize()
+        if rng.random() < 0.2:
+            name += ' ' + rng.choice(['Trucks', 'Motors', 'Diesel', str(rng.randint(1, 99))])
+        if blandify_str(name) not in known:
+            known.add(blandify_str(name))
+            catalog.append(name)
+    return catalog
+
+def make_utterance(rng, catalog, n_words, typo_density):
+    'Makes an answer of about n_words words that mentions a brand every few words'
+    words = []
+    while len(words) < n_words:
+        if rng.random() < 0.3:
+            brand = rng.choice(catalog)
+            words.append(add_typo(rng, brand) if rng.random() < typo_density else brand)
+        else:
+            words.append(rng.choice(filler_words))
+    return ' '.join(words)
+
+def best_time_per_op(f, inputs, setup=None, repeats=n_repeats):
+    'Runs f over all inputs repeats times. Returns the best time per call in microseconds.'
+    best = None
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for x in inputs:
+            f(x)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(inputs) * 1e6
+
+def import_seconds():
+    'Imports trucks_nlp in a fresh interpreter, returns the import time it reports'
+    output = subprocess.run([sys.executable, '-c', 'import trucks_nlp; print(trucks_nlp.import_seconds)'], capture_output=True, text=True, check=True).stdout
+    return float(output)
+
+def try_call(f, x):
+    'Calls f(x), returns None instead of raising ValueError on answers that are not numbers'
+    try:
+        return f(x)
+    except ValueError:
+        return None
+
+def run_benchmarks(sizes, quick=False):
+    'Runs all benchmarks. Returns the metrics (microseconds per call) by name.'
+    rng = random.Random(0)
+    n_inputs = 20 if quick else 100
+    results = {}
+
+    # Cold start
+    results['import_trucks_nlp'] = min(import_seconds() for i in range(n_repeats)) * 1e6
+
+    # Functions that don't depend on the catalog
+    answers = [rng.choice(['12', ' 7 ', 'twenty', 'Three', '-1', 'bla', '3.5', '12,000', '']) for i in range(1000)]
+    results['sanitize_int'] = best_time_per_op(lambda s: try_call(sanitize_int, s), answers)
+    results['sanitize_float'] = best_time_per_op(lambda s: try_call(sanitize_float, s), answers)
+    brands = get_brands('brands.txt')
+    for n_words in utterance_lengths:
+        for typo_density in typo_densities:
+            utterances = [make_utterance(rng, brands, n_words, typo_density) for i in range(1000)]
+            results[f'blandify_str[words={n_words},typos={typo_density}]'] = best_time_per_op(blandify_str, utterances)
+
+    for size in sizes:
+        rng = random.Random(size) # Same catalog and inputs for a size, whatever other sizes are run
+        catalog = synthetic_catalog(size, rng)
+
+        # Reading the brands file
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write(''.join(b + '\n' for b in catalog))
+        try:
+            results[f'get_brands[catalog={size}]'] = best_time_per_op(get_brands, [f.name], repeats=3)
+        finally:
+            os.remove(f.name)
+
+        # Building the index
+        start = time.perf_counter()
+        brand_index = BrandIndex(catalog)
+        results[f'BrandIndex[catalog={size}]'] = (time.perf_counter() - start) * 1e6
+
+        # Pairwise fuzzy matching, of brands with typos against other brands of about the same length
+        pairs = []
+        for i in range(n_inputs * 10):
+            brand = blandify_str(rng.choice(catalog))
+            pairs.append((add_typo(rng, brand), blandify_str(rng.choice(catalog))))
+            pairs.append((add_typo(rng, brand), brand))
+        results[f'fuzzy_match[catalog={size}]'] = best_time_per_op(lambda pair: fuzzy_match(*pair), pairs)
+
+        for n_words in utterance_lengths:
+            for typo_density in typo_densities:
+                n_utterances = max(5, min(n_inputs, n_inputs * 10000 // size)) # Big catalogs are slow, so fewer inputs
+                utterances = [make_utterance(rng, catalog, n_words, typo_density) for i in range(n_utterances)]
+                # Every utterance is different and the cache is cleared before each run, so this measures actual matching
+                results[f'find_brand[catalog={size},words={n_words},typos={typo_density}]'] = best_time_per_op(
+                    lambda s: find_brand(s, brand_index), utterances, setup=brand_index.cache.clear, repeats=3 if size >= 100000 else n_repeats)
+    return results
+
+def check(results, baseline, threshold):
+    'Returns the metrics that are more than threshold (a fraction) slower than in baseline'
+    regressions = []
+    for name, value in results.items():
+        old = baseline.get(name)
+        if old and value > old * (1 + threshold):
+            regressions.append((name, old, value))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for trucks_nlp. Times are in microseconds per call.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=catalog_sizes, help='Catalog sizes')
+    parser.add_argument('--quick', action='store_true', help='Fewer inputs per benchmark')
+    parser.add_argument('--save', metavar='FILE', help='Save the results as baseline')
+    parser.add_argument('--check', metavar='FILE', help='Compare with baseline, exit with error if a metric regressed')
+    parser.add_argument('--threshold', type=float, default=20, help='Allowed slowdown against the baseline in percent (default: 20)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.quick)
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)['results']
+
+    for name, value in results.items():
+        line = f"{name:50} {value:12.2f} us"
+        if baseline is not None and baseline.get(name):
+            line += f"  ({(value / baseline[name] - 1) * 100:+.0f}%)"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'python': sys.version.split()[0], 'results': results}, f, indent=2)
+
+    over_budget = results['import_trucks_nlp'] > trucks_nlp.import_time_budget * 1e6
+    print(f"\nImporting trucks_nlp takes {results['import_trucks_nlp'] / 1000:.1f} ms, budget is {trucks_nlp.import_time_budget * 1000:g} ms" + (' - OVER BUDGET' if over_budget else ''))
+
+    if baseline is not None:
+        regressions = check(results, baseline, args.threshold / 100)
+        if over_budget:
+            regressions.append(('import_trucks_nlp (budget)', trucks_nlp.import_time_budget * 1e6, results['import_trucks_nlp']))
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed more than {args.threshold:g}%:")
+            for name, old, value in regressions:
+                print(f"\t{name}: {old:.2f} us -> {value:.2f} us")
+            sys.exit(1)
+        print(f"\nNo metric regressed more than {args.threshold:g}%")
+
+if __name__ == '__main__':
+    main()
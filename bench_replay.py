@@ -0,0 +1,273 @@
+# This file benchmarks whole chat sessions: it replays the demos and synthetic conversations through the dialogue
+# and reports per-turn latency (time the bot takes between an answer and its next question) and sessions per second.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+
+import run
+from bench_common import add_typo
+from data_store import JsonlStore
+from run import Session, find_brand, run_session
+
+# Brand matches come out of a set, so which way a session takes through the dialogue depends on the hash seed.
+# All runs use this one, so that results stay comparable (and the demo scripts fit the order the bot asks in).
+hash_seed = '0'
+
+# Synthetic workloads: name -> (number of brands, models per brand, share of brand names with a typo, corrections per session)
+workloads = {
+    'small':            (1, 1, 0.0, 0),
+    'medium':           (3, 2, 0.0, 0),
+    'medium_typos':     (3, 2, 0.5, 0),
+    'medium_corrected': (3, 2, 0.0, 2),
+    'large':            (10, 4, 0.3, 1),
+    'xlarge':           (25, 6, 0.3, 2),
+}
+
+class TimedChannel:
+    'Feeds answers to the bot and measures how long the bot takes for every turn'
+    def __init__(self, answer_for):
+        self.answer_for = answer_for    # Returns the answer to a prompt, raises EOFError when there is none
+        self.session = None
+        self.answered_at = None         # When the bot got the last answer
+        self.answered_state = None      # State the last answer was given in
+        self.turns = []                 # Latency of every turn and its state   List[Tuple(String, Float)]
+
+    def end_turn(self):
+        if self.answered_at is not None:
+            self.turns.append((self.answered_state, time.perf_counter() - self.answered_at))
+            self.answered_at = None
+
+    async def input(self, prompt_str):
+        self.end_turn()
+        answer = self.answer_for(prompt_str)
+        self.answered_state = self.session.state.state_id
+        self.answered_at = time.perf_counter()
+        return answer
+
+    def output(self, output_str):
+        if hasattr(self.answer_for, 'output'):
+            self.answer_for.output(output_str)
+
+def script_answers(answers):
+    'Answers with the lines of a script, in order'
+    answers = iter(answers)
+    def answer_for(prompt_str):
+        try:
+            return next(answers)
+        except StopIteration:
+            raise EOFError
+    return answer_for
+
+class SimulatedUser:
+    'Answers the questions of the bot about a generated fleet. Answers by prompt, so it follows the bot wherever it goes.'
+    def __init__(self, rng, n_brands, models_per_brand, typo_rate, corrections):
+        self.rng = rng
+        self.corrections = corrections
+        self.brand = None               # Brand the bot is asking about
+        self.fleet = {}                 # Brand -> list of (model, number of trucks, engine size, axles, weight, max load)
+
+        brands = self.pick_brands(n_brands)
+        for i_brand, brand in enumerate(brands):
+            n_models = rng.randint(1, models_per_brand)
+            self.fleet[brand] = [(f'M{i_brand}{j}', rng.randint(1, 5), rng.choice([2.5, 4, 7.7, 12, 13000]), rng.randint(2, 5),
+                                  rng.randint(5, 30), rng.randint(5, 40)) for j in range(n_models)]
+        self.n_trucks = sum(m[1] for models in self.fleet.values() for m in models)
+        self.brands_answer = self.mention_brands(brands, typo_rate)
+
+    def pick_brands(self, n_brands):
+        'Picks brands that are recognized one by one and all together'
+        catalog = run.brand_catalog.index.brands_list
+        while True:
+            brands = self.rng.sample(catalog, n_brands)
+            if all(find_brand(b, run.brand_catalog.index) == [b] for b in brands) and sorted(find_brand(', '.join(brands), run.brand_catalog.index)) == sorted(brands):
+                return brands
+
+    def mention_brands(self, brands, typo_rate):
+        'Lists the brands, with typos in some of them, as long as the bot still recognizes all of them'
+        mentions = [add_typo(self.rng, b) if len(b) > 5 and self.rng.random() < typo_rate else b for b in brands]
+        answer = ' and '.join([', '.join(mentions[:-1]), mentions[-1]]) if len(mentions) > 1 else mentions[0]
+        if sorted(find_brand(answer, run.brand_catalog.index)) != sorted(brands):
+            return ', '.join(brands)
+        return answer
+
+    def output(self, output_str):
+        match = re.match(r"I will now ask you about your (.+) trucks\. If you want to correct", output_str)
+        if match:
+            self.brand = match.group(1)
+
+    def model(self, name):
+        return next(m for m in self.fleet[self.brand] if m[0] == name)
+
+    def __call__(self, prompt_str):
+        if self.corrections and self.brand is not None and self.rng.random() < 0.05:
+            self.corrections -= 1
+            return self.rng.choice(['start over', f'correct {self.brand}'])
+
+        models = self.fleet.get(self.brand)
+        if prompt_str.startswith("Hello, what's your name?"):
+            return 'Sim User'
+        if 'name of your company' in prompt_str:
+            return 'Sim Inc.'
+        if prompt_str.startswith('Do you own trucks?'):
+            return 'yes'
+        if prompt_str.startswith('How many trucks do you have?'):
+            return str(self.n_trucks)
+        if prompt_str.startswith('What brand'):
+            return self.brands_answer
+        match = re.match(r'How many (.+) trucks do you have\? $', prompt_str)
+        if match:
+            if match.group(1) == self.brand:
+                return str(sum(m[1] for m in models))
+            return str(self.model(match.group(1)[len(self.brand)+1:])[1])
+        if prompt_str.startswith('Are your'):
+            return 'yes' if len(models) == 1 else 'no'
+        if prompt_str.startswith('What is the model of'):
+            return models[0][0]
+        match = re.match(r'What is model #(\d+) among', prompt_str)
+        if match:
+            i_model = int(match.group(1)) - 1
+            return models[i_model][0] if i_model < len(models) else 'none'
+        match = re.match(r'What is the engine size for the (.+) model', prompt_str)
+        if match:
+            engine_size = self.model(match.group(1))[2]
+            return f'{engine_size} cc' if engine_size > 100 else f'{engine_size} l'
+        match = re.match(r'How many axles does the (.+) model have', prompt_str)
+        if match:
+            return str(self.model(match.group(1))[3])
+        match = re.match(r'How much does the (.+) weigh', prompt_str)
+        if match:
+            return f'{self.model(match.group(1))[4]} tons'
+        match = re.match(r'What is the max load for the (.+) model', prompt_str)
+        if match:
+            return str(self.model(match.group(1))[5])
+        raise ValueError(f'Simulated user does not know how to answer: {prompt_str}')
+
+def percentile(values, p):
+    'Returns the p-th percentile of values (nearest rank)'
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def latency_summary(latencies):
+    'p50/p95/p99/max of latencies, in milliseconds'
+    return {
+        'turns': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'max_ms': max(latencies) * 1000 if latencies else None,
+    }
+
+async def run_sessions(make_answer_for, n_sessions, data_store):
+    'Runs n_sessions sessions one after the other. Returns the latencies of all turns and the number of sessions that failed.'
+    turns, failed = [], 0
+    for i_session in range(n_sessions):
+        channel = TimedChannel(make_answer_for(i_session))
+        session = Session(channel)
+        channel.session = session
+        try:
+            await run_session(session, data_store)
+            channel.end_turn()
+        except EOFError: # The script ran out of answers
+            failed += 1
+            run.get_logger(session.log_file).close()
+        turns.extend(channel.turns)
+    return turns, failed
+
+def replay(make_answer_for, n_sessions, data_store):
+    'Runs n_sessions sessions. Returns the results of the workload.'
+    start = time.perf_counter()
+    turns, failed = asyncio.run(run_sessions(make_answer_for, n_sessions, data_store))
+    elapsed = time.perf_counter() - start
+
+    by_state = {}
+    for state_id, latency in turns:
+        by_state.setdefault(state_id, []).append(latency)
+    result = {
+        'sessions': n_sessions,
+        'failed_sessions': failed,
+        'seconds': elapsed,
+        'sessions_per_sec': n_sessions / elapsed,
+    }
+    result.update(latency_summary([latency for _, latency in turns]))
+    result['by_state'] = {state_id: latency_summary(latencies) for state_id, latencies in sorted(by_state.items())}
+    return result
+
+def run_benchmarks(n_sessions, seed, selected):
+    'Runs all selected workloads in a scratch directory. Returns the results by workload.'
+    demos = {name: open(f'{name}.txt').read().splitlines() for name in ['Demo1', 'Demo2']}
+    results = {}
+    old_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir) # Logs, checkpoints and data go to the scratch directory
+        try:
+            data_store = JsonlStore('data.jsonl')
+            for name, answers in demos.items():
+                if selected is None or name in selected:
+                    results[name] = replay(lambda i_session: script_answers(answers), n_sessions, data_store)
+            for name, (n_brands, models_per_brand, typo_rate, corrections) in workloads.items():
+                if selected is None or name in selected:
+                    rng = random.Random(seed)
+                    users = [SimulatedUser(rng, n_brands, models_per_brand, typo_rate, corrections) for i_session in range(n_sessions)]
+                    run.brand_catalog.index.cache.clear() # Generating the users filled the cache with their answers
+                    results[name] = replay(lambda i_session: users[i_session], n_sessions, data_store)
+        finally:
+            os.chdir(old_dir)
+    return results
+
+def compare(results, baseline):
+    'Prints how results changed against baseline'
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        changes = [f"{key} {old[key]:.3g} -> {result[key]:.3g} ({(result[key] / old[key] - 1) * 100:+.0f}%)"
+                   for key in ['p50_ms', 'p95_ms', 'p99_ms', 'sessions_per_sec'] if old.get(key) and result.get(key) is not None]
+        print(f"{name}: " + ', '.join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays the demos and synthetic conversations and reports per-turn latency and sessions per second')
+    parser.add_argument('--sessions', type=int, default=20, help='Sessions per workload')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic conversations')
+    parser.add_argument('--workload', action='append', help=f"Only run this workload (Demo1, Demo2, {', '.join(workloads)}), can be repeated")
+    parser.add_argument('--output', help='Save the results to this json file')
+    parser.add_argument('--compare', help='Compare with results saved before')
+    args = parser.parse_args()
+    if os.environ.get('PYTHONHASHSEED') != hash_seed: # Only read at startup, so start over with it
+        os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED=hash_seed))
+
+    results = run_benchmarks(args.sessions, args.seed, args.workload)
+    for name, result in results.items():
+        print(f"{name:18} {result['sessions_per_sec']:8.1f} sessions/s  p50 {result['p50_ms']:7.3f} ms  p95 {result['p95_ms']:7.3f} ms  p99 {result['p99_ms']:7.3f} ms"
+              + (f"  ({result['failed_sessions']} failed)" if result['failed_sessions'] else ''))
+    failed = [name for name, result in results.items() if result['failed_sessions']]
+    if failed: # Sessions that ran out of answers took another way, their timings say nothing
+        sys.exit(f"Sessions of {', '.join(failed)} did not finish, results are not saved or compared")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'sessions': args.sessions,
+                'seed': args.seed,
+                'hash_seed': hash_seed,
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+if __name__ == '__main__':
+    main()
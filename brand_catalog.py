@@ -0,0 +1,96 @@
+# This file keeps the brand catalog in sync between all sessions and processes running the bot. The brands file is
+# only ever appended to, under a lock, so every process picks up new brands by reading on from where it stopped.
+
+import os
+import threading
+
+from brand_index_file import open_index
+from trucks_nlp import BrandIndex, split_brands
+
+try:
+    import fcntl # Only on Unix. Elsewhere, processes adding brands at the same time are not kept apart.
+except ImportError:
+    fcntl = None
+
+min_mapped_brands = 5000 # From this many brands on, the index is mapped from a compiled index file instead of built at startup
+
+class BrandCatalog:
+    'The brands file together with its BrandIndex. New brands go in with add_if_absent, brands added by other processes come in with refresh.'
+    def __init__(self, brands_file):
+        self.brands_file = brands_file
+        self.index = None               # Index of all brands read so far                   BrandIndex
+        self.offset = 0                 # Bytes of the brands file read so far              Integer
+        self.file_id = None             # (device, inode) of the file we read               Tuple(Integer, Integer)
+        self.version = 0                # Incremented for every brand picked up, never goes down    Integer
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        'Picks up brands added to the file since the last call. Only a stat if nothing changed.'
+        try:
+            stat = os.stat(self.brands_file)
+        except FileNotFoundError:
+            stat = None
+        if self.index is not None and stat is not None and (stat.st_dev, stat.st_ino) == self.file_id and stat.st_size == self.offset:
+            return
+        with self.lock:
+            self.read_new_brands(shared_lock=True)
+
+    def read_new_brands(self, shared_lock=False):
+        '''
+        Adds the brands after offset to the index, or rebuilds it if the file was replaced or truncated. Call with the lock held.
+        Reads under a shared file lock if shared_lock is set, else the caller holds the exclusive one (our own locks would conflict).
+        '''
+        try:
+            f = open(self.brands_file, 'rb')
+        except FileNotFoundError:
+            if self.index is None:
+                self.index = BrandIndex()
+            return
+        with f:
+            if shared_lock and fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_SH) # Released when the file is closed
+            stat = os.fstat(f.fileno())
+            file_id = (stat.st_dev, stat.st_ino)
+            if self.index is None or file_id != self.file_id or stat.st_size < self.offset: # Not an append, start from scratch
+                self.index, self.offset, self.file_id = BrandIndex(), 0, file_id
+                initial = True
+            else:
+                initial = False
+            f.seek(self.offset)
+            data = f.read()
+
+        # Only complete lines, the rest may still be written. On the first read, a last line without newline is a brand too:
+        # under the file lock nobody is writing, so the brands file just does not end with a newline.
+        end = len(data) if initial and fcntl is not None else data.rfind(b'\n') + 1
+        if initial and data.count(b'\n') >= min_mapped_brands:
+            self.index = open_index(self.brands_file, data[:end])
+            self.version += len(self.index)
+        else:
+            for brand in split_brands(data[:end]):
+                self.index.add(brand)
+                self.version += 1
+        self.offset += end
+
+    def add_if_absent(self, brand):
+        'Adds brand to the file and the index, unless a brand with the same normalized form is known already. Returns whether it was added.'
+        with self.lock, open(self.brands_file, 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX) # No other process adds a brand between our check and our write
+            self.read_new_brands()
+            if brand in self.index:
+                return False
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 1))
+            separator = b'\n' if size > 0 and f.read(1) != b'\n' else b'' # Don't glue the brand to a last line without newline
+            f.write(separator + (brand + '\n').encode())
+            f.flush()
+            self.read_new_brands()
+        return True
+
+    def __contains__(self, brand):
+        self.refresh()
+        return brand in self.index
+
+    def __len__(self):
+        return len(self.index)
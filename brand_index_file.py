@@ -0,0 +1,342 @@
+# This file compiles the BrandIndex of a brands file into a binary index file (brands.txt.idx) and maps it back
+# read-only. Starting from the index file skips normalizing and indexing the catalog, and all processes on a host
+# share the same pages. The index file carries the hash of the brands file it was made from and is compiled again
+# when that changes.
+
+import argparse
+import hashlib
+import json
+import mmap
+import struct
+import sys
+import time
+from array import array
+from collections import defaultdict
+from collections.abc import Sequence
+
+from atomic_file import write_atomic
+from trucks_nlp import BrandBucket, BrandIndex, LRUCache, brand_cache_size, ngram_size, split_brands
+
+index_format = 1                # Increase when the file layout, or the normalization behind it, changes
+magic = b'TRUCKIDX'
+header = struct.Struct('<8sI')  # Magic and length of the table of contents (json) that follows
+alignment = 8                   # Sections start at multiples of this
+
+def index_file(brands_file):
+    'Returns the index file of a brands file'
+    return brands_file + '.idx'
+
+def source_hash(data):
+    'Hash of the content of a brands file'
+    return hashlib.sha256(data).hexdigest()
+
+def packed_strings(strings):
+    'Returns the utf-8 bytes of strings one after the other, and their offsets (one more than strings)'
+    encoded = [s.encode() for s in strings]
+    offsets = array('I', [0])
+    for b in encoded:
+        offsets.append(offsets[-1] + len(b))
+    return b''.join(encoded), offsets
+
+def compiled_index(brands, data_hash=None):
+    'Builds the BrandIndex of brands and returns it in the layout of an index file, as bytes'
+    brand_index = BrandIndex(brands)
+    sections = []                   # (name, bytes)
+    def add(name, content):
+        sections.append((name, bytes(content)))
+
+    for name, strings in [('brands', brand_index.brands_list), ('blands', brand_index.brands_list_bland)]:
+        buffer, offsets = packed_strings(strings)
+        add(name, buffer)
+        add(name + '_offsets', offsets)
+    # Brand indices sorted by bland form, for looking up exact matches. Equal forms stay in catalog order, the last one wins.
+    bland_bytes = [b.encode() for b in brand_index.brands_list_bland]
+    add('bland_order', array('I', sorted(range(len(bland_bytes)), key=lambda i: (bland_bytes[i], i))))
+
+    # n-gram postings, grams sorted
+    grams = sorted(brand_index.ngram_postings, key=lambda gram: gram.encode())
+    buffer, offsets = packed_strings(grams)
+    add('grams', buffer)
+    add('gram_offsets', offsets)
+    posting_offsets, postings = array('I', [0]), array('I')
+    for gram in grams:
+        for idx_brand, count in brand_index.ngram_postings[gram]:
+            postings.extend((idx_brand, count))
+        posting_offsets.append(len(postings) // 2)
+    add('posting_offsets', posting_offsets)
+    add('postings', postings)
+
+    # Brands by length and the compiled lanes of every bucket
+    buckets = {}
+    for len_brand, bucket in sorted(brand_index.buckets.items()):
+        bucket.compile()
+        add(f'bucket_{len_brand}', array('I', bucket.brand_ids))
+        buckets[len_brand] = sorted(bucket.char_masks)
+        for c in buckets[len_brand]:
+            add(f'bucket_{len_brand}_{c}', bucket.char_masks[c].to_bytes(len(bucket.blands) * bucket.lane_bytes, 'little'))
+
+    # Lay out the sections after the table of contents
+    toc = {
+        'format': index_format,
+        'source_hash': data_hash,
+        'ngram_size': ngram_size,
+        'byteorder': sys.byteorder,
+        'n_brands': len(brand_index),
+        'max_bland_len': brand_index.max_bland_len,
+        'buckets': {str(len_brand): chars for len_brand, chars in buckets.items()},
+        'sections': {},
+    }
+    def layout(start):
+        offset = start
+        for name, content in sections:
+            offset += -offset % alignment
+            toc['sections'][name] = [offset, len(content)]
+            offset += len(content)
+    toc_size = 0
+    while True: # The offsets depend on the size of the table of contents and the other way round
+        layout(header.size + toc_size)
+        toc_bytes = json.dumps(toc).encode()
+        if len(toc_bytes) <= toc_size:
+            break
+        toc_size = len(toc_bytes) + 64
+
+    compiled = bytearray(header.pack(magic, toc_size) + toc_bytes.ljust(toc_size))
+    for name, content in sections:
+        offset = toc['sections'][name][0]
+        compiled.extend(bytes(offset - len(compiled))) # Padding
+        compiled.extend(content)
+    return compiled
+
+def compile_index(brands, data_hash, path):
+    'Builds the BrandIndex of brands and writes it to path. The file is replaced atomically, readers never see half an index. Returns the compiled index.'
+    compiled = compiled_index(brands, data_hash)
+    write_atomic(path, compiled, sync=True)
+    return compiled
+
+class PackedStrings(Sequence):
+    'Strings stored one after the other in the index file, followed by strings appended after loading'
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer            # Bytes of all strings                 memoryview
+        self.offsets = offsets          # Start of every string, and the end    memoryview of unsigned int
+        self.n = len(offsets) - 1       # Number of strings in the file
+        self.tail = []                  # Strings appended after loading        List[String]
+
+    def __len__(self):
+        return self.n + len(self.tail)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < self.n:
+            return str(self.buffer[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+        return self.tail[i - self.n]
+
+    def raw(self, i):
+        'Bytes of the i-th string in the file'
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i+1]])
+
+    def append(self, s):
+        self.tail.append(s)
+
+class PackedInts(Sequence):
+    'Unsigned ints from the index file, followed by ints appended after loading'
+    def __init__(self, ints):
+        self.ints = ints                # memoryview of unsigned int
+        self.tail = []
+
+    def __len__(self):
+        return len(self.ints) + len(self.tail)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < len(self.ints):
+            return self.ints[i]
+        return self.tail[i - len(self.ints)]
+
+    def __iter__(self):
+        yield from self.ints
+        yield from self.tail
+
+    def append(self, i):
+        self.tail.append(i)
+
+class BlandLookup:
+    'Maps bland forms to brands like BrandIndex.bland2brand, by binary search over the sorted forms in the index file'
+    def __init__(self, brands_list, blands, order):
+        self.brands_list = brands_list  # PackedStrings
+        self.blands = blands            # PackedStrings
+        self.order = order              # Brand indices sorted by bland form    memoryview of unsigned int
+        self.added = {}                 # Brands added after loading win        Dict[String, String]
+
+    def get(self, bland, default=None):
+        brand = self.added.get(bland)
+        if brand is not None:
+            return brand
+        key = bland.encode()
+        lo, hi = 0, len(self.order)
+        while lo < hi: # Last position with a form <= key
+            mid = (lo + hi) // 2
+            if self.blands.raw(self.order[mid]) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0 and self.blands.raw(self.order[lo-1]) == key:
+            return self.brands_list[self.order[lo-1]]
+        return default
+
+    def __getitem__(self, bland):
+        brand = self.get(bland)
+        if brand is None:
+            raise KeyError(bland)
+        return brand
+
+    def __contains__(self, bland):
+        return self.get(bland) is not None
+
+    def __setitem__(self, bland, brand):
+        self.added[bland] = brand
+
+class PackedPostings:
+    'n-gram postings like BrandIndex.ngram_postings: those in the index file, followed by postings of brands added after loading'
+    def __init__(self, grams, offsets, postings):
+        self.grams = grams              # Sorted grams                          PackedStrings
+        self.offsets = offsets          # Start of the postings of every gram   memoryview of unsigned int
+        self.postings = postings        # Brand index and count, interleaved    memoryview of unsigned int
+        self.added = defaultdict(list)  # Postings added after loading          Dict[String, List[Tuple(Integer, Integer)]]
+
+    def find(self, gram):
+        'Position of gram in the file, or None'
+        key = gram.encode()
+        lo, hi = 0, self.grams.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.grams.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.grams.n and self.grams.raw(lo) == key else None
+
+    def get(self, gram, default=None):
+        i = self.find(gram)
+        if i is None:
+            return self.added.get(gram, default)
+        start, end = 2 * self.offsets[i], 2 * self.offsets[i+1]
+        return list(zip(self.postings[start:end:2], self.postings[start+1:end:2])) + self.added.get(gram, [])
+
+    def __getitem__(self, gram):
+        'Postings added after loading, for BrandIndex.add to append to'
+        return self.added[gram]
+
+class MappedBrandBucket(BrandBucket):
+    'BrandBucket whose lanes come compiled from the index file, unless brands were added after loading'
+    def __init__(self, len_brand, brand_ids, blands, char_lanes):
+        super().__init__(len_brand)
+        self.brand_ids = brand_ids      # PackedInts
+        self.blands = blands            # Bland brands of the bucket            BucketBlands
+        self.char_lanes = char_lanes    # Compiled lanes by character           Dict[String, memoryview]
+        self.n_compiled = len(brand_ids)
+
+    def compile(self):
+        if len(self.blands) != self.n_compiled:
+            return super().compile()
+        self.char_masks = {c: int.from_bytes(lanes, 'little') for c, lanes in self.char_lanes.items()}
+        self.ones = int.from_bytes(((1 << self.len_brand) - 1).to_bytes(self.lane_bytes, 'little') * len(self.blands), 'little')
+
+class BucketBlands(Sequence):
+    'Bland forms of the brands in a bucket, looked up by brand index, followed by those appended after loading'
+    def __init__(self, blands, brand_ids):
+        self.blands = blands            # PackedStrings of all brands
+        self.brand_ids = brand_ids      # memoryview of unsigned int
+        self.tail = []
+
+    def __len__(self):
+        return len(self.brand_ids) + len(self.tail)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < len(self.brand_ids):
+            return self.blands[self.brand_ids[i]]
+        return self.tail[i - len(self.brand_ids)]
+
+    def append(self, bland):
+        self.tail.append(bland)
+
+class MappedBrandIndex(BrandIndex):
+    'BrandIndex backed by a memory-mapped index file. Brands can still be added, they are kept in memory.'
+    def __init__(self, mapped, toc):
+        self.mapped = mapped            # Kept open as long as the index is used    mmap, or the compiled bytes
+        view = memoryview(mapped)
+        def section(name, format=None):
+            offset, size = toc['sections'][name]
+            part = view[offset:offset+size]
+            return part.cast(format) if format is not None else part
+
+        self.brands_list = PackedStrings(section('brands'), section('brands_offsets', 'I'))
+        self.brands_list_bland = PackedStrings(section('blands'), section('blands_offsets', 'I'))
+        self.bland2brand = BlandLookup(self.brands_list, self.brands_list_bland, section('bland_order', 'I'))
+        self.ngram_postings = PackedPostings(PackedStrings(section('grams'), section('gram_offsets', 'I')),
+                                             section('posting_offsets', 'I'), section('postings', 'I'))
+        self.buckets = dict()
+        for len_brand, chars in toc['buckets'].items():
+            len_brand = int(len_brand)
+            brand_ids = section(f'bucket_{len_brand}', 'I')
+            self.buckets[len_brand] = MappedBrandBucket(len_brand, PackedInts(brand_ids), BucketBlands(self.brands_list_bland, brand_ids),
+                                                        {c: section(f'bucket_{len_brand}_{c}') for c in chars})
+        self.max_bland_len = toc['max_bland_len']
+        self.version = toc['n_brands']
+        self.cache = LRUCache(brand_cache_size)
+
+def read_toc(mapped):
+    'Returns the table of contents of a mapped index file, or None if it is not one we can read'
+    if len(mapped) < header.size:
+        return None
+    file_magic, toc_size = header.unpack_from(mapped)
+    if file_magic != magic:
+        return None
+    try:
+        toc = json.loads(bytes(mapped[header.size:header.size+toc_size]))
+    except ValueError:
+        return None
+    if toc.get('format') != index_format or toc.get('ngram_size') != ngram_size or toc.get('byteorder') != sys.byteorder:
+        return None
+    return toc
+
+def load_index(path, data_hash):
+    'Maps the index file at path. Returns the MappedBrandIndex, or None if the file is missing, unreadable or not made from data with data_hash.'
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError): # ValueError: empty file
+        return None
+    toc = read_toc(mapped)
+    if toc is None or toc['source_hash'] != data_hash:
+        mapped.close()
+        return None
+    return MappedBrandIndex(mapped, toc)
+
+def open_index(brands_file, data):
+    'Returns the BrandIndex for data, the content of brands_file, from its index file. Compiles the index file first if it is missing or out of date. Never None.'
+    path = index_file(brands_file)
+    data_hash = source_hash(data)
+    brand_index = load_index(path, data_hash)
+    if brand_index is None:
+        compiled = compile_index(split_brands(data), data_hash, path)
+        brand_index = load_index(path, data_hash)
+        if brand_index is None: # Another process already replaced the file, compiled from other brands. Ours is still good, in memory.
+            brand_index = MappedBrandIndex(compiled, read_toc(compiled))
+    return brand_index
+
+def main():
+    parser = argparse.ArgumentParser(description='Compiles the index file of a brands file, so that bot processes can map it instead of building the index')
+    parser.add_argument('brands_file', nargs='?', default='brands.txt', help='Brands file (default: brands.txt)')
+    args = parser.parse_args()
+    with open(args.brands_file, 'rb') as f:
+        data = f.read()
+    start = time.perf_counter()
+    compile_index(split_brands(data), source_hash(data), index_file(args.brands_file))
+    print(f"Compiled {index_file(args.brands_file)} in {time.perf_counter() - start:.2f} s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# This file runs brand matching in a pool of worker processes, so that fuzzy matching long answers against a large
+# catalog does not hold up the other sessions of a process, and uses all cores. The catalog goes to the workers once,
+# compiled into a shared memory block (same layout as the index file), instead of being pickled with every call.
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import metrics
+from brand_index_file import MappedBrandIndex, compiled_index, read_toc
+from trucks_nlp import find_brand_mentions
+
+max_added_brands = 1000 # Brands added after the snapshot that are sent along with every call, beyond this a new snapshot is made
+
+# Workers are not forked from this process: a fork copies locks that other threads hold at that moment, e.g. while releasing an old snapshot
+mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# In worker processes
+worker_memory = None            # Shared memory block with the catalog        SharedMemory
+worker_index = None             # Index on that block, plus brands added later  MappedBrandIndex
+
+def init_worker(memory_name, metrics_enabled):
+    'Attaches the worker to the shared catalog'
+    global worker_memory, worker_index
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    worker_index = MappedBrandIndex(worker_memory.buf, read_toc(worker_memory.buf))
+    if metrics_enabled:
+        metrics.reset() # Counters of the parent, if it is a fork, are not ours to hand back
+        metrics.enable()
+
+def match_in_worker(s, added_brands):
+    '''
+    Runs find_brand in a worker. added_brands are all brands added to the catalog since the snapshot, the worker adds those it lacks.
+    Returns the brands in the order they are mentioned, as the order of a set differs between processes, and the counters
+    find_brand collected if metrics are enabled, for the parent to add to its own.
+    '''
+    for brand in added_brands[len(worker_index) - worker_index.brands_list.n:]:
+        worker_index.add(brand)
+    mentions = find_brand_mentions(s, worker_index)
+    return mentions, metrics.take_counters() if metrics.enabled else None
+
+def release_snapshot(memory, executor):
+    'Waits for the calls still running on an old snapshot, then stops its workers and frees its shared memory'
+    executor.shutdown()
+    memory.close()
+    memory.unlink()
+
+class BrandMatcher:
+    'Runs find_brand on the brands of a BrandCatalog in worker processes. Usable from synchronous code and from coroutines.'
+    def __init__(self, catalog, workers=None):
+        self.catalog = catalog
+        self.workers = workers or os.cpu_count() or 1
+        self.index = None               # Catalog index the snapshot was taken of     BrandIndex
+        self.n_snapshot = 0             # Brands in the snapshot                      Integer
+        self.memory = None              # Shared memory block with the snapshot       SharedMemory
+        self.executor = None
+        self.lock = threading.Lock()    # Snapshots are taken in another thread, while the event loop goes on submitting
+        self.releases = []              # Threads releasing old snapshots               List[Thread]
+        self.pending_snapshot = None    # Snapshot being taken for coroutines         asyncio.Future
+        self.snapshot()
+
+    def needs_snapshot(self):
+        'Picks up brands added to the catalog. Returns whether the snapshot is out of date.'
+        self.catalog.refresh()
+        return self.catalog.index is not self.index or len(self.index) - self.n_snapshot > max_added_brands
+
+    def snapshot(self):
+        'Puts the current catalog into a new shared memory block and starts workers on it. The old snapshot goes when its calls are done.'
+        index = self.catalog.index
+        if isinstance(index, MappedBrandIndex): # Already compiled, copy the file
+            compiled, n_snapshot = index.mapped, index.brands_list.n
+        else:
+            brands = list(index.brands_list)
+            compiled, n_snapshot = compiled_index(brands), len(brands)
+        memory = shared_memory.SharedMemory(create=True, size=len(compiled))
+        memory.buf[:len(compiled)] = compiled
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context, initializer=init_worker, initargs=(memory.name, metrics.enabled))
+
+        with self.lock:
+            old_memory, old_executor = self.memory, self.executor
+            self.index, self.n_snapshot, self.memory, self.executor = index, n_snapshot, memory, executor
+        if old_executor is not None: # Don't wait here, calls still running on the old snapshot may take a while
+            release = threading.Thread(target=release_snapshot, args=(old_memory, old_executor), name='brand matcher release', daemon=True)
+            release.start()
+            self.releases = [r for r in self.releases if r.is_alive()] + [release]
+
+    def submit(self, s):
+        'Starts matching s in a worker on the current snapshot. Returns a concurrent.futures.Future with the result of match_in_worker.'
+        with self.lock:
+            added_brands = [self.index.brands_list[i] for i in range(self.n_snapshot, len(self.index))]
+            return self.executor.submit(match_in_worker, s, added_brands)
+
+    def result(self, worker_result):
+        'Returns the brands found by match_in_worker like find_brand does, adding its counters to ours'
+        mentions, counters = worker_result
+        if counters:
+            metrics.add_counters(counters)
+        return list(set(mentions))
+
+    def find_brand(self, s):
+        'Like trucks_nlp.find_brand on the catalog, waiting for the result'
+        if self.needs_snapshot():
+            self.snapshot()
+        return self.result(self.submit(s).result())
+
+    async def find_brand_async(self, s):
+        'Like trucks_nlp.find_brand on the catalog, other coroutines run while a worker is matching or a new snapshot is taken'
+        if self.needs_snapshot():
+            if self.pending_snapshot is None: # Calls coming in meanwhile wait for the same snapshot
+                self.pending_snapshot = asyncio.get_running_loop().run_in_executor(None, self.snapshot)
+                self.pending_snapshot.add_done_callback(lambda future: setattr(self, 'pending_snapshot', None))
+            await asyncio.shield(self.pending_snapshot) # A cancelled session must not cancel it for the others
+        return self.result(await asyncio.wrap_future(self.submit(s)))
+
+    def close(self):
+        'Stops the workers and frees the shared memory, also of old snapshots'
+        release_snapshot(self.memory, self.executor)
+        for release in self.releases:
+            release.join()
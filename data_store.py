@@ -0,0 +1,256 @@
+# This file stores the data collected in chat sessions, either as lines of json or in an indexed sqlite database
+
+import argparse
+import io
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import fcntl # Only on Unix. Elsewhere, processes writing to the same jsonl file are not kept apart.
+except ImportError:
+    fcntl = None
+
+migrate_batch_size = 1000 # Records per transaction when importing
+
+class JsonlStore:
+    'Appends every session as a line of json. Cheap to write, but every query has to read the whole file.'
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, record):
+        'Stores the data of a session'
+        self.write_many([record])
+
+    @contextmanager
+    def locked_file(self):
+        'Opens the file for appending, locked against other processes writing to it at the same time'
+        with open(self.path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+            f.flush() # Before the lock goes away with the file
+
+    def write_many(self, records):
+        'Stores the data of many sessions at once'
+        with self.locked_file() as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+
+    def write_session(self, trucks_info):
+        'Stores the data collected in a session (a TrucksInfo)'
+        self.write_sessions([trucks_info])
+
+    def write_sessions(self, sessions):
+        'Stores the data collected in many sessions at once, streaming their json to a buffer without building dicts'
+        buffer = io.StringIO() # All of it goes to the file in one write, a failing session leaves no partial line behind
+        for trucks_info in sessions:
+            trucks_info.write_json(buffer)
+            buffer.write('\n')
+        with self.locked_file() as f:
+            f.write(buffer.getvalue())
+
+    def sync(self):
+        'Makes sure that everything written so far is on disk'
+        with open(self.path, 'a') as f:
+            os.fsync(f.fileno())
+
+    def records(self):
+        'Yields the data of all sessions'
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def close(self):
+        pass
+
+class SqliteStore:
+    'Stores sessions normalized into companies, brands and truck models, with indexes on all three'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS companies (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS brands (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS models (
+            id INTEGER PRIMARY KEY,
+            brand_id INTEGER NOT NULL REFERENCES brands(id),
+            name TEXT NOT NULL,
+            UNIQUE (brand_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            company_id INTEGER REFERENCES companies(id),
+            total_trucks INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS trucks (
+            session_id INTEGER NOT NULL REFERENCES sessions(id),
+            model_id INTEGER NOT NULL REFERENCES models(id),
+            brand_idx INTEGER,
+            n_trucks INTEGER,
+            engine_size REAL,
+            axle_number INTEGER,
+            weight REAL,
+            max_load REAL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_company ON sessions(company_id);
+        CREATE INDEX IF NOT EXISTS sessions_total_trucks ON sessions(total_trucks);
+        CREATE INDEX IF NOT EXISTS models_name ON models(name);
+        CREATE INDEX IF NOT EXISTS trucks_session ON trucks(session_id);
+        CREATE INDEX IF NOT EXISTS trucks_model ON trucks(model_id);
+    '''
+
+    def __init__(self, path, synchronous='NORMAL'):
+        self.path = path
+        self.synchronous = synchronous  # FULL: every commit is on disk when it returns. NORMAL: still safe against corruption with WAL, but the last commits may be lost on power failure.
+        self.db = sqlite3.connect(path, check_same_thread=False) # Writes may come from a GroupWriter thread
+        self.db.execute('PRAGMA journal_mode=WAL')   # Readers don't block the writer and vice versa
+        self.db.execute(f'PRAGMA synchronous={synchronous}')
+        self.db.executescript(self.schema)
+        self.ids = {}                   # Ids of companies, brands and models    Dict[Tuple, Integer]
+
+    def get_id(self, table, key, insert, select):
+        'Returns the id of a row in table, inserting it if needed. Inserting first keeps another process from adding the same row in between.'
+        id = self.ids.get((table,) + key)
+        if id is None:
+            self.db.execute(insert, key) # INSERT OR IGNORE: does nothing if the row is there already
+            id = self.db.execute(select, key).fetchone()[0]
+            self.ids[(table,) + key] = id
+        return id
+
+    def company_id(self, company):
+        return self.get_id('companies', (company,), 'INSERT OR IGNORE INTO companies (name) VALUES (?)', 'SELECT id FROM companies WHERE name = ?')
+
+    def model_id(self, brand, model):
+        brand_id = self.get_id('brands', (brand,), 'INSERT OR IGNORE INTO brands (name) VALUES (?)', 'SELECT id FROM brands WHERE name = ?')
+        return self.get_id('models', (brand_id, model), 'INSERT OR IGNORE INTO models (brand_id, name) VALUES (?, ?)', 'SELECT id FROM models WHERE brand_id = ? AND name = ?')
+
+    def insert(self, record):
+        'Inserts the data of a session, inside the current transaction'
+        session_id = self.db.execute('INSERT INTO sessions (name, company_id, total_trucks) VALUES (?, ?, ?)',
+                                     (record['name'], self.company_id(record['company']), record['total_trucks'])).lastrowid
+        self.db.executemany('INSERT INTO trucks VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+            (session_id, self.model_id(t['brand'], t['model']), t.get('brand_idx'), t['n_trucks'],
+             t['engine_size'], t['axle_number'], t['weight'], t['max_load'])
+            for t in record['trucks']])
+
+    def write(self, record):
+        'Stores the data of a session'
+        self.write_many([record])
+
+    def write_many(self, records):
+        'Stores the data of many sessions in a single transaction'
+        try:
+            with self.db:
+                for record in records:
+                    self.insert(record)
+        except sqlite3.Error:
+            self.ids.clear() # Ids of a rolled back transaction may be gone
+            raise
+
+    def write_session(self, trucks_info):
+        'Stores the data collected in a session (a TrucksInfo)'
+        self.write_sessions([trucks_info])
+
+    def write_sessions(self, sessions):
+        'Stores the data collected in many sessions in a single transaction'
+        self.write_many(trucks_info.to_dict() for trucks_info in sessions)
+
+    def sync(self):
+        'Nothing to do: with synchronous=FULL every commit is on disk already, with NORMAL SQLite syncs the WAL at its own checkpoints'
+        pass
+
+    def records(self):
+        'Yields the data of all sessions, in the same format as the json lines'
+        sessions = self.db.execute('''SELECT sessions.id, sessions.name, companies.name, total_trucks
+                                      FROM sessions LEFT JOIN companies ON companies.id = company_id ORDER BY sessions.id''')
+        for session_id, name, company, total_trucks in sessions:
+            trucks = self.db.execute('''SELECT brands.name, brand_idx, models.name, engine_size, axle_number, weight, max_load, n_trucks
+                                        FROM trucks JOIN models ON models.id = model_id JOIN brands ON brands.id = brand_id
+                                        WHERE session_id = ? ORDER BY trucks.rowid''', (session_id,))
+            yield {
+                'name':name,
+                'company':company,
+                'total_trucks':total_trucks,
+                'trucks':[dict(zip(['brand', 'brand_idx', 'model', 'engine_size', 'axle_number', 'weight', 'max_load', 'n_trucks'], t)) for t in trucks]
+            }
+
+    def companies_with_brand(self, brand):
+        'Returns the names of all companies that have trucks of brand'
+        rows = self.db.execute('''SELECT DISTINCT companies.name FROM brands
+                                  JOIN models ON models.brand_id = brands.id
+                                  JOIN trucks ON trucks.model_id = models.id
+                                  JOIN sessions ON sessions.id = trucks.session_id
+                                  JOIN companies ON companies.id = sessions.company_id
+                                  WHERE brands.name = ? ORDER BY companies.name''', (brand,))
+        return [row[0] for row in rows]
+
+    def companies_with_model(self, model):
+        'Returns the names of all companies that have trucks of a model with this name, of any brand'
+        rows = self.db.execute('''SELECT DISTINCT companies.name FROM models
+                                  JOIN trucks ON trucks.model_id = models.id
+                                  JOIN sessions ON sessions.id = trucks.session_id
+                                  JOIN companies ON companies.id = sessions.company_id
+                                  WHERE models.name = ? ORDER BY companies.name''', (model,))
+        return [row[0] for row in rows]
+
+    def fleets_larger_than(self, n_trucks):
+        'Returns (name, company, total_trucks) of all sessions with more than n_trucks trucks, largest first'
+        return self.db.execute('''SELECT sessions.name, companies.name, total_trucks
+                                  FROM sessions LEFT JOIN companies ON companies.id = company_id
+                                  WHERE total_trucks > ? ORDER BY total_trucks DESC''', (n_trucks,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+# Store classes by file extension
+stores = {
+    '.jsonl': JsonlStore,
+    '.json': JsonlStore,
+    '.db': SqliteStore,
+    '.sqlite': SqliteStore,
+    '.sqlite3': SqliteStore,
+}
+
+def open_store(path, fsync=None):
+    'Opens the data store for path, picking the backend by file extension. fsync is the policy of the GroupWriter the store is for, if any.'
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in stores:
+        raise ValueError(f"Don't know how to store data in {path}, use one of {', '.join(stores)}")
+    if stores[extension] is SqliteStore: # SQLite syncs its commits itself, it has to know whether to do so for every one
+        return SqliteStore(path, synchronous='FULL' if fsync == 'always' else 'NORMAL')
+    return stores[extension](path)
+
+def migrate(source, target):
+    'Imports all sessions from the store source into the store target, in batches. Returns the number of sessions.'
+    n, batch = 0, []
+    for record in source.records():
+        batch.append(record)
+        if len(batch) >= migrate_batch_size:
+            target.write_many(batch)
+            n, batch = n + len(batch), []
+    if batch:
+        target.write_many(batch)
+        n += len(batch)
+    return n
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports collected data from one store into another, e.g. data.jsonl into data.db')
+    parser.add_argument('source', help='File to read from')
+    parser.add_argument('target', help='File to write to (created if missing)')
+    args = parser.parse_args()
+    source, target = open_store(args.source), open_store(args.target)
+    try:
+        n = migrate(source, target)
+    finally:
+        source.close()
+        target.close()
+    print(f"Imported {n} sessions from {args.source} into {args.target}")
+
+if __name__ == '__main__':
+    main()
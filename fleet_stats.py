@@ -0,0 +1,197 @@
+# This file computes statistics over the collected data. It streams data.jsonl and keeps a checkpoint,
+# so that every run only reads the sessions appended since the last one.
+
+import argparse
+import json
+import math
+import os
+
+from atomic_file import write_atomic
+
+checkpoint_suffix = '.stats.json' # Checkpoint of data.jsonl is data.jsonl.stats.json
+
+# Bin widths of the distributions
+bin_widths = {
+    'engine_size': 1.0,     # litres
+    'weight': 5.0,          # tons
+    'max_load': 5.0,        # tons
+}
+
+def read_lines(f, offset=0):
+    'Yields (end offset, line) for all complete lines of the binary file f after byte offset. A last line without newline is still being written, so we leave it for next time.'
+    f.seek(offset)
+    for line in f:
+        if not line.endswith(b'\n'):
+            return
+        offset += len(line)
+        yield offset, line
+
+def parse_records(lines):
+    'Yields (end offset, record) for all non-empty lines'
+    for offset, line in lines:
+        if line.strip():
+            yield offset, json.loads(line)
+
+class Distribution:
+    'Count, mean, standard deviation, range and histogram of a quantity, updated one value at a time'
+    def __init__(self, bin_width):
+        self.bin_width = bin_width
+        self.count = 0                  # Number of values                      Integer
+        self.total = 0.0                # Sum of values                         Float
+        self.total_sq = 0.0             # Sum of squared values                 Float
+        self.min = None                 # Float
+        self.max = None                 # Float
+        self.histogram = {}             # Count by lower end of bin             Dict[Float, Integer]
+
+    def add(self, value, weight=1):
+        'Adds value weight times'
+        if value is None:
+            return
+        self.count += weight
+        self.total += value * weight
+        self.total_sq += value * value * weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bin = math.floor(value / self.bin_width) * self.bin_width
+        self.histogram[bin] = self.histogram.get(bin, 0) + weight
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def std(self):
+        if not self.count:
+            return None
+        return math.sqrt(max(self.total_sq / self.count - self.mean() ** 2, 0.0))
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['histogram'] = [[bin, n] for bin, n in sorted(self.histogram.items())] # json keys must be strings
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        distribution = cls(d['bin_width'])
+        distribution.__dict__.update(d)
+        distribution.histogram = {bin: n for bin, n in d['histogram']}
+        return distribution
+
+class FleetStats:
+    'Aggregates over all sessions, all of which can be updated with new sessions without going over the old ones again'
+    def __init__(self):
+        self.offset = 0                 # Bytes of the data file we have read   Integer
+        self.file_id = None             # [device, inode] of the data file we read  List[Integer]
+        self.n_sessions = 0             # Integer
+        self.total_trucks = 0           # Sum of fleet sizes                    Integer
+        self.brand_trucks = {}          # Trucks by brand                       Dict[String, Integer]
+        self.model_trucks = {}          # Trucks by brand and model             Dict[String, Dict[String, Integer]]
+        self.distributions = {quantity: Distribution(bin_width) for quantity, bin_width in bin_widths.items()}
+
+    def add_session(self, record):
+        'Counts a session and its trucks'
+        self.n_sessions += 1
+        self.total_trucks += record['total_trucks'] or 0
+        for truck in record['trucks']:
+            self.add_truck(truck)
+
+    def add_truck(self, truck):
+        'Counts the trucks of one model of a session'
+        n = truck['n_trucks']
+        self.brand_trucks[truck['brand']] = self.brand_trucks.get(truck['brand'], 0) + n
+        models = self.model_trucks.setdefault(truck['brand'], {})
+        models[truck['model']] = models.get(truck['model'], 0) + n
+        for quantity, distribution in self.distributions.items():
+            distribution.add(truck[quantity], n)
+
+    def update(self, path):
+        'Adds all sessions appended to path since the last update'
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError: # No data (anymore)
+            self.__init__()
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            file_id = [stat.st_dev, stat.st_ino] # A list, as it comes back from the checkpoint
+            if file_id != self.file_id or stat.st_size < self.offset: # The file was replaced or truncated, so we start over
+                self.__init__()
+                self.file_id = file_id
+            for offset, record in parse_records(read_lines(f, self.offset)):
+                self.add_session(record)
+                self.offset = offset
+
+    def average_fleet_size(self):
+        return self.total_trucks / self.n_sessions if self.n_sessions else None
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['distributions'] = {quantity: distribution.to_dict() for quantity, distribution in self.distributions.items()}
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.__dict__.update(d)
+        stats.distributions = {quantity: Distribution.from_dict(distribution) for quantity, distribution in d['distributions'].items()}
+        return stats
+
+    def report(self):
+        'Returns the statistics as a json-serializable dict'
+        return {
+            'sessions': self.n_sessions,
+            'average_fleet_size': self.average_fleet_size(),
+            'trucks_by_brand': dict(sorted(self.brand_trucks.items(), key=lambda kv: -kv[1])),
+            'trucks_by_model': {brand: dict(sorted(models.items(), key=lambda kv: -kv[1])) for brand, models in sorted(self.model_trucks.items())},
+            'distributions': {quantity: {'count': d.count, 'mean': d.mean(), 'std': d.std(), 'min': d.min, 'max': d.max,
+                                         'histogram': {str(bin): n for bin, n in sorted(d.histogram.items())}}
+                              for quantity, d in self.distributions.items()},
+        }
+
+    def pretty_print(self):
+        'Print out the statistics'
+        print(f"Sessions: {self.n_sessions}")
+        average = self.average_fleet_size()
+        print(f"Average fleet size: {average:.2f}" if average is not None else "Average fleet size: -")
+        print("\nTrucks by brand:")
+        for brand, n in sorted(self.brand_trucks.items(), key=lambda kv: -kv[1]):
+            print(f"\t{brand}: {n}")
+            for model, n_model in sorted(self.model_trucks[brand].items(), key=lambda kv: -kv[1]):
+                print(f"\t\t{model}: {n_model}")
+        for quantity, d in self.distributions.items():
+            if not d.count:
+                continue
+            print(f"\n{quantity}: mean {d.mean():.2f}, std {d.std():.2f}, min {d.min}, max {d.max}")
+            for bin, n in sorted(d.histogram.items()):
+                print(f"\t[{bin:g}, {bin + d.bin_width:g}): {n}")
+
+def load_stats(checkpoint_file):
+    'Loads the aggregates from the checkpoint, or starts from scratch if there is none'
+    try:
+        with open(checkpoint_file) as f:
+            return FleetStats.from_dict(json.load(f))
+    except FileNotFoundError:
+        return FleetStats()
+
+def save_stats(stats, checkpoint_file):
+    'Saves the aggregates to the checkpoint'
+    write_atomic(checkpoint_file, json.dumps(stats.to_dict()))
+
+def main():
+    parser = argparse.ArgumentParser(description='Statistics over the collected data. Only sessions added since the last run are read.')
+    parser.add_argument('data_file', nargs='?', default='data.jsonl', help='Data file (.jsonl)')
+    parser.add_argument('--checkpoint', help=f'Checkpoint file (default: data file + {checkpoint_suffix})')
+    parser.add_argument('--full', action='store_true', help='Ignore the checkpoint and read all of the data file')
+    parser.add_argument('--json', action='store_true', help='Print the statistics as json')
+    args = parser.parse_args()
+
+    checkpoint_file = args.checkpoint or args.data_file + checkpoint_suffix
+    stats = FleetStats() if args.full else load_stats(checkpoint_file)
+    stats.update(args.data_file)
+    save_stats(stats, checkpoint_file)
+
+    if args.json:
+        print(json.dumps(stats.report(), indent=2))
+    else:
+        stats.pretty_print()
+
+if __name__ == '__main__':
+    main()
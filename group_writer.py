@@ -0,0 +1,156 @@
+# This file writes the data of finished sessions in groups: sessions are put on a queue, possibly from several
+# processes, and a writer thread appends whatever has piled up to the data store in one go, under a file lock,
+# and syncs it to disk according to the fsync policy. Many sessions share one open, write and fsync.
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+max_group_size = 100    # Sessions per commit at most
+max_group_wait = 0.02   # Seconds to wait for more sessions after the first one of a commit
+fsync_interval = 1.0    # Seconds between syncs with the 'interval' policy
+
+# When to sync to disk: after every commit, at most every fsync_interval seconds, or leave it to the OS
+fsync_policies = ['always', 'interval', 'never']
+
+class GroupWriter:
+    'Data store that queues sessions and writes them to data_store in groups from a writer thread'
+    def __init__(self, data_store, session_queue=None, fsync='always', max_size=max_group_size, max_wait=max_group_wait, interval=fsync_interval):
+        if fsync not in fsync_policies:
+            raise ValueError(f"Unknown fsync policy {fsync}, use one of {', '.join(fsync_policies)}")
+        if fsync == 'always' and getattr(data_store, 'synchronous', 'FULL') != 'FULL':
+            raise ValueError(f"{data_store.path} does not sync every commit, open it with open_store(path, fsync='always')")
+        self.data_store = data_store
+        self.path = data_store.path
+        self.queue = session_queue if session_queue is not None else queue.Queue() # Also a multiprocessing queue, see QueueStore
+        self.fsync = fsync
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.interval = interval
+        self.last_sync = time.monotonic()
+        self.error = None               # First exception of a failed commit
+
+        # Commit statistics
+        self.n_commits = 0
+        self.n_sessions = 0
+        self.commit_seconds = 0.0       # Total time spent writing and syncing
+        self.max_commit_seconds = 0.0
+        self.wait_seconds = 0.0         # Total time sessions spent from queued to on disk
+        self.max_wait_seconds = 0.0
+
+        self.writer = threading.Thread(target=self.run_writer, name=f'group writer {self.path}', daemon=True)
+        self.writer.start()
+
+    def write_session(self, trucks_info):
+        'Queues the data of a session. Returns a Future that is done when it is committed.'
+        committed = Future()
+        self.queue.put((time.time(), trucks_info, committed))
+        return committed
+
+    def write_sessions(self, sessions):
+        'Queues the data of many sessions. Returns a Future per session.'
+        return [self.write_session(trucks_info) for trucks_info in sessions]
+
+    def next_group(self):
+        'Waits for the next sessions to commit. Returns them and whether the writer was told to stop.'
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        group = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(group) < self.max_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return group, True
+            group.append(item)
+        return group, False
+
+    def run_writer(self):
+        'Loop of the writer thread'
+        stop = False
+        while not stop:
+            group, stop = self.next_group()
+            if group:
+                self.commit(group)
+
+    def commit(self, group):
+        'Writes a group of (time queued, session, future) to the data store and syncs it if the policy says so'
+        start = time.perf_counter()
+        try:
+            self.data_store.write_sessions([trucks_info for queued, trucks_info, committed in group])
+            if self.fsync == 'always' or (self.fsync == 'interval' and time.monotonic() - self.last_sync >= self.interval):
+                self.sync()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            for queued, trucks_info, committed in group:
+                if committed is not None:
+                    committed.set_exception(e)
+            return
+
+        now = time.time()
+        seconds = time.perf_counter() - start
+        self.n_commits += 1
+        self.n_sessions += len(group)
+        self.commit_seconds += seconds
+        self.max_commit_seconds = max(self.max_commit_seconds, seconds)
+        for queued, trucks_info, committed in group:
+            self.wait_seconds += now - queued
+            self.max_wait_seconds = max(self.max_wait_seconds, now - queued)
+            if committed is not None:
+                committed.set_result(None)
+        if metrics.enabled:
+            metrics.observe('commit', seconds)
+            metrics.inc('committed_sessions', len(group))
+            for queued, trucks_info, committed in group:
+                metrics.observe('commit_wait', now - queued)
+
+    def sync(self):
+        self.data_store.sync()
+        self.last_sync = time.monotonic()
+
+    def stats(self):
+        'Returns commit statistics: counts, and average and max latency in milliseconds'
+        return {
+            'commits': self.n_commits,
+            'sessions': self.n_sessions,
+            'sessions_per_commit': self.n_sessions / self.n_commits if self.n_commits else None,
+            'avg_commit_ms': self.commit_seconds / self.n_commits * 1000 if self.n_commits else None,
+            'max_commit_ms': self.max_commit_seconds * 1000,
+            'avg_wait_ms': self.wait_seconds / self.n_sessions * 1000 if self.n_sessions else None,
+            'max_wait_ms': self.max_wait_seconds * 1000,
+        }
+
+    def close(self):
+        'Commits all queued sessions, stops the writer thread and closes the data store. Raises the error of a failed commit.'
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        if self.fsync == 'interval' and self.error is None:
+            self.sync()
+        self.data_store.close()
+        if self.error is not None:
+            raise self.error
+
+class QueueStore:
+    'Data store for worker processes: puts sessions on the multiprocessing queue of a GroupWriter in the parent process'
+    def __init__(self, session_queue, path):
+        self.queue = session_queue
+        self.path = path
+
+    def write_session(self, trucks_info):
+        self.queue.put((time.time(), trucks_info, None)) # Futures don't cross processes
+
+    def write_sessions(self, sessions):
+        for trucks_info in sessions:
+            self.write_session(trucks_info)
+
+    def close(self):
+        pass
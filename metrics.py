@@ -0,0 +1,110 @@
+# This file collects optional metrics: time spent per dialogue state, brand matching counters and I/O timings.
+# Off by default; then every instrumented place only pays for checking metrics.enabled.
+
+import atexit
+import json
+import threading
+import time
+
+from atomic_file import write_atomic
+
+enabled = False                 # Set by enable(), checked before measuring anything
+prefix = 'trucks_'              # Prefix of metric names in Prometheus format
+export_interval = 10.0          # Seconds between snapshots written by the exporter
+
+lock = threading.Lock()
+counters = {}                   # Counts by name and labels                 Dict[Tuple(String, Tuple), Float]
+timings = {}                    # [count, total seconds, max seconds] by name and labels    Dict[Tuple(String, Tuple), List]
+
+def enable():
+    'Starts collecting metrics'
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    'Drops all collected metrics'
+    with lock:
+        counters.clear()
+        timings.clear()
+
+def inc(name, n=1, **labels):
+    'Adds n to a counter'
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + n
+
+def take_counters():
+    'Returns all counters and drops them, so that a worker process can hand them over to its parent with add_counters'
+    with lock:
+        taken = list(counters.items())
+        counters.clear()
+    return taken
+
+def add_counters(taken):
+    'Adds counters returned by take_counters'
+    with lock:
+        for key, n in taken:
+            counters[key] = counters.get(key, 0) + n
+
+def observe(name, seconds, **labels):
+    'Records a duration'
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        timing = timings.get(key)
+        if timing is None:
+            timings[key] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+def snapshot():
+    'Returns all metrics as a json-serializable dict'
+    with lock:
+        return {
+            'time': time.time(),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(counters.items())],
+            'timings': [{'name': name, 'labels': dict(labels), 'count': count, 'seconds': total, 'max_seconds': max_seconds}
+                        for (name, labels), (count, total, max_seconds) in sorted(timings.items())],
+        }
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+def prometheus_text():
+    'Returns all metrics in the Prometheus text format. Timings are summaries with count, sum and max.'
+    data = snapshot()
+    lines = []
+    for name in sorted(set(c['name'] for c in data['counters'])):
+        lines.append(f'# TYPE {prefix}{name}_total counter')
+        lines.extend(f"{prefix}{name}_total{format_labels(c['labels'])} {c['value']}" for c in data['counters'] if c['name'] == name)
+    for name in sorted(set(t['name'] for t in data['timings'])):
+        lines.append(f'# TYPE {prefix}{name}_seconds summary')
+        for t in data['timings']:
+            if t['name'] == name:
+                lines.append(f"{prefix}{name}_seconds_count{format_labels(t['labels'])} {t['count']}")
+                lines.append(f"{prefix}{name}_seconds_sum{format_labels(t['labels'])} {t['seconds']}")
+        lines.append(f'# TYPE {prefix}{name}_seconds_max gauge')
+        lines.extend(f"{prefix}{name}_seconds_max{format_labels(t['labels'])} {t['max_seconds']}" for t in data['timings'] if t['name'] == name)
+    return '\n'.join(lines) + '\n'
+
+def write(path):
+    'Writes all metrics to path, as json if it ends with .json, else in Prometheus text format'
+    text = json.dumps(snapshot(), indent=2) if path.endswith('.json') else prometheus_text()
+    write_atomic(path, text) # Scrapers never see half a file
+
+def start_exporter(path, interval=export_interval):
+    'Enables metrics and writes them to path every interval seconds and on exit'
+    enable()
+    def run_exporter():
+        while True:
+            time.sleep(interval)
+            write(path)
+    threading.Thread(target=run_exporter, name='metrics exporter', daemon=True).start()
+    atexit.register(write, path)
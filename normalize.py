@@ -0,0 +1,82 @@
+# This file normalizes user input and brand names, so that all comparisons are made on lowercase ascii
+
+import re
+import unicodedata
+from functools import cached_property
+
+# Special characters are replaced by whitespace in a single translate pass
+special_chars = '-,_.;:!"\'$%^&*()=+[]{}\\/?<>|'
+special_chars_table = str.maketrans(special_chars, ' ' * len(special_chars))
+
+token_pattern = re.compile(r'\S+')
+
+def fold_accents(s):
+    'Removes accents and other diacritics, e.g. Škoda -> Skoda'
+    if s.isascii():
+        return s
+    return ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
+
+def tokenize(s):
+    'Tokenizes the bland form of s. Returns the list of tokens and the list of their (start, end) character offsets in s.'
+    if s.isascii(): # Lowercasing and replacing special characters keeps every character in place
+        bland = s.lower().translate(special_chars_table)
+        matches = list(token_pattern.finditer(bland))
+        return [m.group() for m in matches], [m.span() for m in matches]
+
+    # Folding accents can change the length, so we go character by character to keep track of offsets
+    tokens, offsets = [], []
+    token, start = [], None
+    for i, c in enumerate(s):
+        for c_bland in fold_accents(c.lower()).translate(special_chars_table):
+            if c_bland.isspace():
+                if token:
+                    tokens.append(''.join(token))
+                    offsets.append((start, i))
+                    token = []
+            else:
+                if not token:
+                    start = i
+                token.append(c_bland)
+    if token:
+        tokens.append(''.join(token))
+        offsets.append((start, len(s)))
+    return tokens, offsets
+
+def blandify_str(s):
+    'Convert a string to lowercase, fold accents and replace special characters.'
+    if s.isascii():
+        return ' '.join(s.lower().translate(special_chars_table).split())
+    return ' '.join(tokenize(s)[0])
+
+class Utterance(str):
+    'User input that computes its normalized forms once and keeps them for all checks in the same turn'
+
+    @cached_property
+    def stripped(self):
+        return str(self).strip()
+
+    @cached_property
+    def lowered(self):
+        return str(self).lower()
+
+    @cached_property
+    def tokenized(self):
+        return tokenize(self)
+
+    @property
+    def tokens(self):
+        return self.tokenized[0]
+
+    @property
+    def offsets(self):
+        return self.tokenized[1]
+
+    @cached_property
+    def bland(self):
+        return ' '.join(self.tokens)
+
+def as_utterance(s):
+    'Wraps s into an Utterance, unless it already is one'
+    if isinstance(s, Utterance):
+        return s
+    return Utterance(s)
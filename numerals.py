@@ -0,0 +1,128 @@
+# This file reads numbers written in English words and/or digits, e.g. "twenty five", "a hundred and forty", "1,200", "two point five"
+
+import re
+from functools import lru_cache
+
+# Tokens: digits with optional thousands separators and decimals, words, and any other single character
+token_pattern = re.compile(r"(\d{1,3}(?:,\d{3})+|\d+)(\.\d+)?|([a-z]+)|(\S)")
+
+units = {
+    'zero':0, 'one':1, 'two':2, 'three':3, 'four':4, 'five':5, 'six':6, 'seven':7, 'eight':8, 'nine':9,
+}
+teens = {
+    'ten':10, 'eleven':11, 'twelve':12, 'thirteen':13, 'fourteen':14, 'fifteen':15, 'sixteen':16, 'seventeen':17, 'eighteen':18, 'nineteen':19,
+}
+tens = {
+    'twenty':20, 'thirty':30, 'forty':40, 'fourty':40, 'fifty':50, 'sixty':60, 'seventy':70, 'eighty':80, 'ninety':90,
+}
+multipliers = {'hundred':100, 'dozen':12} # Multiply the number said since the last scale word
+scales = {'thousand':1000, 'million':10**6, 'billion':10**9} # Close a group, e.g. "two hundred thousand"
+minus_words = {'minus', 'negative', '-'}
+
+# Kinds of tokens that may come before a kind of token, None being the start
+may_follow = {
+    'unit':         {None, 'tens', 'multiplier', 'scale', 'and'},
+    'teen':         {None, 'multiplier', 'scale', 'and'},
+    'tens':         {None, 'multiplier', 'scale', 'and'},
+    'digits':       {None},
+    'a':            {None, 'and', 'scale'},
+    'multiplier':   {'unit', 'teen', 'tens', 'a', 'digits'},
+    'scale':        {'unit', 'teen', 'tens', 'a', 'digits', 'multiplier'},
+    'and':          {'multiplier', 'scale'},
+}
+
+def tokenize(s):
+    'Splits s into (kind, value) tokens. Raises ValueError on characters that are not part of a number.'
+    tokens = []
+    for m in token_pattern.finditer(s):
+        digits, decimals, word, other = m.groups()
+        if digits is not None:
+            tokens.append(('digits', float(digits.replace(',', '') + decimals) if decimals else int(digits.replace(',', ''))))
+        elif word is not None:
+            if word in units:
+                tokens.append(('unit', units[word]))
+            elif word in teens:
+                tokens.append(('teen', teens[word]))
+            elif word in tens:
+                tokens.append(('tens', tens[word]))
+            elif word in multipliers:
+                tokens.append(('multiplier', multipliers[word]))
+            elif word in scales:
+                tokens.append(('scale', scales[word]))
+            elif word in ('a', 'an'):
+                tokens.append(('a', 1))
+            elif word in ('and', 'point', 'half') or word in minus_words:
+                tokens.append((word, None))
+            else:
+                raise ValueError
+        elif other == '-':
+            # Between words it is a hyphen (twenty-five), at the start a minus
+            tokens.append(('-', None) if not tokens else ('hyphen', None))
+        else:
+            raise ValueError
+    return [t for t in tokens if t[0] != 'hyphen']
+
+def parse_tokens(tokens):
+    'Reads the number from its tokens in a single pass'
+    sign = 1
+    if tokens and tokens[0][0] in minus_words:
+        sign = -1
+        tokens = tokens[1:]
+    fraction = 0
+    if [kind for kind, value in tokens[-3:]] == ['and', 'a', 'half']: # "two and a half"
+        fraction, tokens = 0.5, tokens[:-3]
+    elif [kind for kind, value in tokens] in (['a', 'half'], ['half']):
+        return sign * 0.5
+    if 'point' in [kind for kind, value in tokens]: # "two point five": only single digits after the point
+        i_point = [kind for kind, value in tokens].index('point')
+        decimals = tokens[i_point+1:]
+        if not decimals or any(kind != 'unit' for kind, value in decimals):
+            raise ValueError
+        fraction = float('0.' + ''.join(str(value) for kind, value in decimals))
+        tokens = tokens[:i_point]
+        if not tokens: # "point five"
+            return sign * fraction
+    if not tokens:
+        raise ValueError
+
+    total = 0           # Sum of closed groups, e.g. 2000 in "two thousand three hundred"
+    group = 0           # Number said since the last scale word
+    multiplied = False  # Whether the group already had a "hundred"
+    last_kind = None
+    last_scale = None
+    for kind, value in tokens:
+        if kind not in may_follow or last_kind not in may_follow[kind]:
+            raise ValueError
+        if kind == 'unit' and value == 0 and len(tokens) > 1: # "zero" only stands alone
+            raise ValueError
+        if kind in ('unit', 'teen', 'tens', 'digits', 'a'):
+            group += value
+        elif kind == 'multiplier':
+            if multiplied: # "two hundred fifty hundred" is not a number
+                raise ValueError
+            group *= value
+            multiplied = True
+        elif kind == 'scale':
+            if last_scale is not None and value >= last_scale: # "thousand million" is not a number
+                raise ValueError
+            total += group * value
+            group, multiplied, last_scale = 0, False, value
+        last_kind = kind
+    if last_kind in ('and', 'a'):
+        raise ValueError
+    return sign * (total + group + fraction)
+
+@lru_cache(maxsize=4096)
+def parse_number_or_none(s):
+    'Like parse_number, but returns None if s is not a number. Cached, because the same answers come up again and again.'
+    try:
+        return parse_tokens(tokenize(s.lower()))
+    except ValueError:
+        return None
+
+def parse_number(s):
+    'Reads a number given in English words and/or digits. Returns an int for whole numbers, else a float. Raises ValueError if s is not a number.'
+    number = parse_number_or_none(s.strip())
+    if number is None:
+        raise ValueError
+    return number
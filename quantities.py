@@ -0,0 +1,70 @@
+# This file reads quantities with units, e.g. "3000 cc", "6 tons", "12,000 lbs", converts them and checks their range
+
+import re
+from collections import namedtuple
+
+from trucks_nlp import sanitize_float
+
+# Units by what they measure, with their factor to the unit we store (litres for volume, tons for mass).
+# Power units are there to recognize engine power given instead of engine size.
+Unit = namedtuple('Unit', ['dimension', 'factor'])
+units = {
+    'l': Unit('volume', 1), 'litre': Unit('volume', 1), 'litres': Unit('volume', 1), 'liter': Unit('volume', 1), 'liters': Unit('volume', 1), 'ltr': Unit('volume', 1),
+    'cc': Unit('volume', 0.001), 'ccm': Unit('volume', 0.001), 'cm³': Unit('volume', 0.001), 'cm3': Unit('volume', 0.001), 'cubic centimeters': Unit('volume', 0.001),
+    'ci': Unit('volume', 0.016387064), 'cu in': Unit('volume', 0.016387064), 'cubic inches': Unit('volume', 0.016387064),
+    't': Unit('mass', 1), 'ton': Unit('mass', 1), 'tons': Unit('mass', 1), 'tonne': Unit('mass', 1), 'tonnes': Unit('mass', 1), 'metric tons': Unit('mass', 1),
+    'kg': Unit('mass', 0.001), 'kgs': Unit('mass', 0.001), 'kilo': Unit('mass', 0.001), 'kilos': Unit('mass', 0.001), 'kilograms': Unit('mass', 0.001),
+    'lb': Unit('mass', 0.00045359237), 'lbs': Unit('mass', 0.00045359237), 'pound': Unit('mass', 0.00045359237), 'pounds': Unit('mass', 0.00045359237),
+    'short ton': Unit('mass', 0.90718474), 'short tons': Unit('mass', 0.90718474), 'long ton': Unit('mass', 1.0160469088), 'long tons': Unit('mass', 1.0160469088),
+    'kw': Unit('power', None), 'hp': Unit('power', None), 'ps': Unit('power', None), 'bhp': Unit('power', None), 'horsepower': Unit('power', None),
+}
+
+# A unit at the end of the answer, after a digit or a space (so that "eight" is not 8 "t"), longest aliases first
+unit_pattern = re.compile(r'(?:(?<=[\d.])|(?<=\s))(' + '|'.join(re.escape(u) for u in sorted(units, key=len, reverse=True)) + r')\.?$')
+
+# What we ask for: dimension, allowed range in stored units and what to tell the user when the answer does not fit
+Field = namedtuple('Field', ['dimension', 'min', 'max', 'range_message', 'unit_message'])
+fields = {
+    'engine_size': Field('volume', 1, 20, "Engine size seems to be too high or low, please check!",
+                         "Engine size must given as number with optional unit - either cc or litres"),
+    'weight':      Field('mass', 0, 80, "Weight seems to be too high or low, please check!",
+                         "Weight must be given as number with optional unit - tons, kg or lbs"),
+    'max_load':    Field('mass', 0, 80, "Max load seems to be too high or low, please check!",
+                         "Max load must be given as number with optional unit - tons, kg or lbs"),
+}
+power_message = "That looks like the engine power. I need the engine size (displacement), in litres or cc."
+number_message = "That does not look like a number to me. Let's try again."
+
+class QuantityError(ValueError):
+    'Raised when an answer is not a valid quantity. The message says what to tell the user.'
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+def split_unit(s):
+    'Splits s into its number part and its unit (None if there is none)'
+    s = s.strip().lower()
+    match = unit_pattern.search(s)
+    if match is None:
+        return s, None
+    return s[:match.start()].strip(), match.group(1)
+
+def parse_quantity(field_name, s):
+    'Reads the answer s for field_name, converts it to the stored unit and checks its range. Raises QuantityError.'
+    field = fields[field_name]
+    number_str, unit_name = split_unit(s)
+    unit = units[unit_name] if unit_name is not None else None
+    if unit is not None and unit.dimension != field.dimension:
+        raise QuantityError(power_message if unit.dimension == 'power' and field.dimension == 'volume' else field.unit_message)
+
+    try:
+        value = sanitize_float(number_str)
+    except ValueError:
+        raise QuantityError(number_message)
+
+    if unit is not None and unit.factor != 1: # Convert if necessary
+        value = value * unit.factor
+
+    if not field.min <= value <= field.max: # Also catches nan
+        raise QuantityError(field.range_message)
+    return value
@@ -1,23 +1,42 @@
+import argparse
+import asyncio
 import json
 import os
-import re
 import time
-
-from trucks_nlp import is_yes_answer, is_no_answer, sanitize_int, sanitize_float, sanitize_str, blandify_str, get_brands, find_brand
-
-data_file = 'data.jsonl' # Where to store the collected data
+from collections import namedtuple
+
+import metrics
+from atomic_file import write_atomic
+from brand_catalog import BrandCatalog
+from data_store import open_store
+from normalize import Utterance, as_utterance
+from quantities import QuantityError, parse_quantity
+from session_log import get_logger
+from trucks_nlp import is_yes_answer, is_no_answer, sanitize_int, sanitize_str, blandify_str, find_brand
+
+data_file = 'data.jsonl' # Where to store the collected data, either .jsonl or a sqlite database (.db)
 brands_file = 'brands.txt' # List of brand names
-
-# File for chat logs
-current_time = time.strftime("%Y-%m-%d_%H-%M-%S")
-log_file_base = f'{current_time}.log'
-log_file, suffix = log_file_base, 1
-while os.path.exists(log_file):
-    log_file = f'{log_file_base}_{suffix}'
-    suffix += 1
+brand_catalog = BrandCatalog(brands_file) # Normalized brands, shared by all sessions and kept up to date with other processes
+brand_matcher = None # Optional BrandMatcher, matches brands in worker processes instead of in the dialogue loop
+
+def new_log_file():
+    'Picks a file name for a chat log that is not taken yet, and creates the file so that no other session picks it too'
+    current_time = time.strftime("%Y-%m-%d_%H-%M-%S")
+    log_file_base = f'{current_time}.log'
+    log_file, suffix = log_file_base, 1
+    while True:
+        try:
+            open(log_file, 'x').close()
+            return log_file
+        except FileExistsError:
+            log_file = f'{log_file_base}_{suffix}'
+            suffix += 1
 
 class TrucksInfo:
     'Holds complete information of a chat session'
+    # Members, in the order they go to checkpoints. Slots instead of a __dict__, there can be thousands of sessions in a process.
+    members = ('name', 'company', 'n_trucks', 'brands_list', 'n_trucks_brand', 'brand_same_model', 'brand_models', 'trucks_list', 'completeness')
+
     def __init__(self):
         self.name = None                # Client name                           String
         self.company = None             # Client company                        String
@@ -28,6 +47,53 @@ class TrucksInfo:
         self.brand_models = [[]]        # List of truck models for that brand   List[String]
         self.trucks_list = []           # List of truck models and their number List[Tuple(TruckSpec, Integer)]
         self.completeness = None        # Counts number of trucks for brands    List[Integer]
+        self.recount()
+
+    # Running totals, kept up to date by set_brand_trucks and add_model, so that checking consistency does not
+    # need to go over all brands and models. They are derived from the members above and not checkpointed.
+    counters = ('n_trucks_known', 'n_brands_outstanding', 'n_brands_non_positive', 'n_trucks_models', 'n_brands_overfull')
+    __slots__ = members + counters
+
+    def recount(self):
+        'Computes the running totals from scratch'
+        self.n_trucks_known = 0         # Sum of the known numbers of trucks per brand      Integer
+        self.n_brands_outstanding = 0   # Brands we don't know the number of trucks for     Integer
+        self.n_brands_non_positive = 0  # Brands with zero or less trucks                   Integer
+        self.n_trucks_models = [0] * len(self.brands_list) # Sum of trucks over models per brand   List[Integer]
+        self.n_brands_overfull = 0      # Brands with more trucks among models than in total    Integer
+        for n in self.n_trucks_brand or []:
+            self.count_brand_trucks(n, 1)
+        for truck_spec, n in self.trucks_list:
+            self.n_trucks_models[truck_spec.brand_idx] += n
+        if self.n_trucks_brand is not None:
+            self.n_brands_overfull = sum(self.is_overfull(i_brand) for i_brand in range(len(self.brands_list)))
+
+    def count_brand_trucks(self, n, sign):
+        'Adds (sign 1) or removes (sign -1) the number of trucks of a brand to/from the running totals'
+        if n is None:
+            self.n_brands_outstanding += sign
+        else:
+            self.n_trucks_known += sign * n
+            self.n_brands_non_positive += sign * (n < 1)
+
+    def is_overfull(self, i_brand):
+        'Whether there are more trucks among the models of a brand than the brand has'
+        return self.n_trucks_brand[i_brand] is not None and self.n_trucks_models[i_brand] > self.n_trucks_brand[i_brand]
+
+    def set_brand_trucks(self, i_brand, n):
+        'Sets the number of trucks of a brand (None if unknown)'
+        overfull = self.is_overfull(i_brand)
+        self.count_brand_trucks(self.n_trucks_brand[i_brand], -1)
+        self.n_trucks_brand[i_brand] = n
+        self.count_brand_trucks(n, 1)
+        self.n_brands_overfull += self.is_overfull(i_brand) - overfull
+
+    def add_model(self, truck_spec, n):
+        'Adds n trucks of a model'
+        overfull = self.is_overfull(truck_spec.brand_idx)
+        self.trucks_list.append((truck_spec, n))
+        self.n_trucks_models[truck_spec.brand_idx] += n
+        self.n_brands_overfull += self.is_overfull(truck_spec.brand_idx) - overfull
 
     def start_over(self):
         'Starts over input after brand selection'
@@ -36,14 +102,17 @@ class TrucksInfo:
         self.brand_models = [[]] * len(self.brands_list)
         self.trucks_list = []
         self.completeness = [0] * len(self.brands_list)
+        self.recount()
 
     def start_over_brand(self, i_brand):
         'Starts over input for specific brand'
         brand = self.brands_list[i_brand]
-        self.n_trucks_brand[i_brand] = None
+        self.set_brand_trucks(i_brand, None)
         self.brand_same_model[i_brand] = None
         self.brand_models[i_brand] = []
-        self.trucks_list = [t for t in self.trucks_list if t[0].brand != brand]
+        if self.n_trucks_models[i_brand]: # Only go over the models if there are any for this brand
+            self.trucks_list = [t for t in self.trucks_list if t[0].brand != brand]
+            self.n_trucks_models[i_brand] = 0
         self.completeness[i_brand] = 0
         
     def pretty_print(self):
@@ -71,12 +140,12 @@ class TrucksInfo:
                 print(f"\t\tWeight: {t[0].weight}")
                 print(f"\t\tMax load: {t[0].max_load}")
     
-    def to_json(self):
-        'Serialize to json'
+    def to_dict(self):
+        'Collected data as a dict, as it goes to the data store'
         trucks_list = []
-        for t in self.trucks_list:
-            t_dict = t[0].__dict__
-            t_dict['n_trucks'] = t[1]
+        for truck_spec, n_trucks in self.trucks_list:
+            t_dict = truck_spec.to_dict()
+            t_dict['n_trucks'] = n_trucks
             trucks_list.append(t_dict)
         data_dict = {
             'name':self.name,
@@ -84,10 +153,41 @@ class TrucksInfo:
             'total_trucks':self.n_trucks,
             'trucks':trucks_list
         }
-        return json.dumps(data_dict)
+        return data_dict
+
+    def to_json(self):
+        'Serialize to json'
+        return json.dumps(self.to_dict())
+
+    def write_json(self, f):
+        'Writes the same json as to_json to the stream f, piece by piece instead of building the dict first'
+        f.write(f'{{"name": {json.dumps(self.name)}, "company": {json.dumps(self.company)}, "total_trucks": {json.dumps(self.n_trucks)}, "trucks": [')
+        for i, (truck_spec, n_trucks) in enumerate(self.trucks_list):
+            if i > 0:
+                f.write(', ')
+            truck_spec.write_json(f, n_trucks)
+        f.write(']}')
+
+    def to_checkpoint(self):
+        'Returns all members as a json-serializable dict, including data of unfinished brands'
+        checkpoint = {member: getattr(self, member) for member in self.members}
+        checkpoint['trucks_list'] = [[t[0].to_dict(), t[1]] for t in self.trucks_list]
+        return checkpoint
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint):
+        'Inverse of to_checkpoint'
+        trucks_info = cls()
+        for member in cls.members:
+            setattr(trucks_info, member, checkpoint[member])
+        trucks_info.trucks_list = [(TruckSpec.from_dict(t[0]), t[1]) for t in checkpoint['trucks_list']]
+        trucks_info.recount()
+        return trucks_info
 
 class TruckSpec:
     'Holds specification for a truck model'
+    __slots__ = ('brand', 'brand_idx', 'model', 'engine_size', 'axle_number', 'weight', 'max_load') # In the order they go to the data store
+
     def __init__(self):
         self.brand = None               # String
         self.brand_idx = None           # Index of brand corresponding to scheme in TrucksInfo
@@ -96,493 +196,540 @@ class TruckSpec:
         self.axle_number = None         # Integer
         self.weight = None              # Float (Unit: tons)
         self.max_load = None            # Float (Unit: tons)
-    
+
     def __repr__(self):
-        return repr(self.__dict__)
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        'Returns the members as a new dict'
+        return {member: getattr(self, member) for member in self.__slots__}
+
+    def write_json(self, f, n_trucks):
+        'Writes the members and n_trucks as a json object to the stream f'
+        f.write('{' + ', '.join(f'"{member}": {json.dumps(getattr(self, member))}' for member in self.__slots__) + f', "n_trucks": {json.dumps(n_trucks)}}}')
+
+    @classmethod
+    def from_dict(cls, d):
+        'Makes a TruckSpec from the dict of its members'
+        truck_spec = cls()
+        for member, value in d.items():
+            setattr(truck_spec, member, value)
+        return truck_spec
 
 # BOT INPUT AND OUTPUT
 
-def bot_input(outfile, prompt_str):
-    'Wrapper around input for logging to outfile'
-    with open(outfile, 'a') as f:
-        f.write('BOT: ' + prompt_str + '\n')
-        input_str = input(prompt_str)
-        f.write('USER: ' + input_str + '\n')
-    return input_str
-
-def bot_output(outfile, output_str):
-    'Wrapper around print for logging to outfile'
-    print(output_str)
-    with open(outfile, 'a') as f:
-        f.write('BOT: ' + output_str + '\n')
-
-# BOT DIALOGUE FUNCTIONS
-# All dialogue functions save data in trucks_info
-# Every dialogue function returns the function where the conversation flows next
-
-def ask_name(trucks_info):
-    'Asks for name'
-    name = bot_input(log_file, "Hello, what's your name? ")
+class ConsoleChannel:
+    'Talks to the user on stdin and stdout'
+    async def input(self, prompt_str):
+        return input(prompt_str) # Blocking is fine, there is only one session on the console
+
+    def output(self, output_str):
+        print(output_str)
+
+class StreamChannel:
+    'Talks to the user over an asyncio stream, one line per message'
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def input(self, prompt_str):
+        self.writer.write((prompt_str + '\n').encode())
+        await self.writer.drain()
+        line = await self.reader.readline()
+        if not line: # Connection closed
+            raise EOFError
+        return line.decode().rstrip('\r\n')
+
+    def output(self, output_str):
+        self.writer.write((output_str + '\n').encode())
+
+class Session:
+    'State of one chat: where we are in the conversation, the collected information, the chat log and the channel to the user'
+    __slots__ = ('channel', 'log_file', 'trucks_info', 'state', 'truck_spec')
+
+    def __init__(self, channel, log_file=None):
+        self.channel = channel
+        self.log_file = log_file if log_file is not None else new_log_file()
+        self.trucks_info = TrucksInfo()
+        self.state = None               # Where the session is in the conversation          State
+        self.truck_spec = None          # Model we are asking details about right now       TruckSpec
+
+async def bot_input(session, prompt_str):
+    'Wrapper around input for logging to the session log'
+    logger = get_logger(session.log_file)
+    logger.write('BOT: ' + prompt_str)
+    input_str = await session.channel.input(prompt_str)
+    logger.write('USER: ' + input_str)
+    return Utterance(input_str) # Normalized forms are computed once and shared by all checks on this answer
+
+def bot_output(session, output_str):
+    'Wrapper around print for logging to the session log'
+    session.channel.output(output_str)
+    get_logger(session.log_file).write('BOT: ' + output_str)
+
+# BOT DIALOGUE
+# The conversation is a state machine. Where a session is in the conversation is a State, which together with
+# its TrucksInfo (and the TruckSpec being asked about) is all there is to a session, so it can be saved and resumed at any point.
+# The state table has an entry for every state (and sub-step) with three functions:
+#   enter(session)          Runs when the conversation gets to the state. Returns the next state if there is nothing to ask, else None.
+#   prompt(session)         Returns the question for the state.
+#   answer(session, answer) Handles the answer and returns the state where the conversation flows next.
+# Dialogue functions save data in session.trucks_info
+
+State = namedtuple('State', ['state_id', 'i_brand', 'model_name', 'sub_step'], defaults=[None, None, None])
+Step = namedtuple('Step', ['enter', 'prompt', 'answer'])
+
+done = State('done') # We are done
+
+def answer_name(session, name):
+    'Handles name'
     try:
         name = sanitize_str(name)
     except ValueError:
-        bot_output(log_file, "You can tell me your name, we are GDPR-compliant.")
-        return ask_name
+        bot_output(session, "You can tell me your name, we are GDPR-compliant.")
+        return State('ask_name')
 
-    trucks_info.name = name
-    return ask_company # Next action: Ask about company
+    session.trucks_info.name = name
+    return State('ask_company') # Next action: Ask about company
 
-def ask_company(trucks_info):
-    'Asks for company name'
-    company = bot_input(log_file, f"Hi {trucks_info.name}, what's the name of your company? ")
+def answer_company(session, company):
+    'Handles company name'
     try:
         company = sanitize_str(company)
     except ValueError:
-        bot_output(log_file, "You can tell me your company name, we are GDPR-compliant.")
-        return ask_company
+        bot_output(session, "You can tell me your company name, we are GDPR-compliant.")
+        return State('ask_company')
 
-    trucks_info.company = company
-    return ask_trucks # Next action: Ask about trucks
+    session.trucks_info.company = company
+    return State('ask_trucks') # Next action: Ask about trucks
 
-
-def ask_trucks(trucks_info):
-    'Asks whether user owns trucks'
-    trucks_yesno = bot_input(log_file, f"Do you own trucks? ")
+def answer_trucks(session, trucks_yesno):
+    'Handles whether user owns trucks'
     if is_yes_answer(trucks_yesno):
-        return ask_how_many  # Next action: Ask about number of trucks
+        return State('ask_how_many')  # Next action: Ask about number of trucks
     elif is_no_answer(trucks_yesno):
-        trucks_info.n_trucks = 0
-        bot_output(log_file, "Ok, that was easy :) Bye!")
-        return None          # Next action: None (We are done)
+        session.trucks_info.n_trucks = 0
+        bot_output(session, "Ok, that was easy :) Bye!")
+        return done                   # Next action: None (We are done)
     else:
-        bot_output(log_file, "I am not sure I understood you. Let's try again.")
-        return ask_trucks    # Next action: Repeat this one
+        bot_output(session, "I am not sure I understood you. Let's try again.")
+        return State('ask_trucks')    # Next action: Repeat this one
 
-def ask_how_many(trucks_info):
-    'Asks how many trucks the user owns.'
-    answer_how_many = bot_input(log_file, f"How many trucks do you have? ")
+def answer_how_many(session, answer_how_many):
+    'Handles how many trucks the user owns.'
+    trucks_info = session.trucks_info
 
     # Sanitize integer input (Total number of trucks)
     try:
         n_trucks = sanitize_int(answer_how_many)
     except ValueError:
-        bot_output(log_file, "That does not look like a number to me. Let's try again.")
-        return ask_how_many # Next action: ask again about number of trucks
+        bot_output(session, "That does not look like a number to me. Let's try again.")
+        return State('ask_how_many') # Next action: ask again about number of trucks
 
     if n_trucks < 0:
-        bot_output(log_file, "Nice try, but I will not fall for negative trucks!")
-        return ask_how_many # Next action: ask again about number of trucks
+        bot_output(session, "Nice try, but I will not fall for negative trucks!")
+        return State('ask_how_many') # Next action: ask again about number of trucks
 
     trucks_info.n_trucks = n_trucks
 
     if trucks_info.n_trucks == 0:
-        bot_output(log_file, "Ok, that was easy :) Bye!")
-        return None     # Next action: None (We are done)
-    return ask_brands   # Next action: ask about brands
-
-def ask_brands(trucks_info):
-    'Asks about brands'
-    brands_list = get_brands(brands_file)
-    prompt = "What brands are your trucks? " if trucks_info.n_trucks > 1 else "What brand is your truck? "
-    answer_brands = bot_input(log_file, prompt)
-    brands_matches = find_brand(answer_brands, brands_list)
+        bot_output(session, "Ok, that was easy :) Bye!")
+        return done                  # Next action: None (We are done)
+    return State('ask_brands')       # Next action: ask about brands
+
+def prompt_brands(session):
+    return "What brands are your trucks? " if session.trucks_info.n_trucks > 1 else "What brand is your truck? "
+
+async def answer_brands(session, answer_brands):
+    'Handles brands'
+    trucks_info = session.trucks_info
+    if brand_matcher is not None: # Other sessions go on while a worker process is matching
+        brands_matches = await brand_matcher.find_brand_async(answer_brands)
+    else:
+        brand_catalog.refresh() # Brands other processes added in the meantime
+        brands_matches = find_brand(answer_brands, brand_catalog.index)
     if len(brands_matches) > 0:
         if len(brands_matches) > trucks_info.n_trucks:
-            bot_output(log_file, "You seem to have more brands than trucks! Let's try again!")
-            return ask_how_many
-            
-        bot_output(log_file, 'I understand you have the following brands: ' + ', '.join(brands_matches))
+            bot_output(session, "You seem to have more brands than trucks! Let's try again!")
+            return State('ask_how_many')
+
+        bot_output(session, 'I understand you have the following brands: ' + ', '.join(brands_matches))
         trucks_info.brands_list = brands_matches
-        return ask_trucks_start # Next action: Start asking about trucks
+        return State('ask_trucks_start') # Next action: Start asking about trucks
     else:
-        return ask_add_brand # Next action: Ask about adding a brand
+        return State('ask_add_brand') # Next action: Ask about adding a brand
 
-def ask_add_brand(trucks_info):
-    'Asks user if he wants to add a brand'
-    add_brand_yesno = bot_input(log_file, "I did not recognize any brand name. Do you want me to add a brand to the database? ")
+def answer_add_brand(session, add_brand_yesno):
+    'Handles whether user wants to add a brand'
     if is_yes_answer(add_brand_yesno):
-        return prompt_new_brand # Next action: Prompt for new brand
+        return State('prompt_new_brand') # Next action: Prompt for new brand
     elif is_no_answer(add_brand_yesno):
-        return ask_brands # Next action: Ask again for brands
+        return State('ask_brands') # Next action: Ask again for brands
     else:
-        bot_output(log_file, "I am not sure I understood you. Let's try again.")
-        return ask_add_brand # Next action: Repeat this one
+        bot_output(session, "I am not sure I understood you. Let's try again.")
+        return State('ask_add_brand') # Next action: Repeat this one
 
-def prompt_new_brand(trucks_info):
-    'Prompts user for new brand and adds it to the brands file'
-    new_brand = bot_input(log_file, "Which name should I add to the brand database? Answer 'none' if you changed your mind. ")
+def answer_new_brand(session, new_brand):
+    'Adds new brand to the brands file'
     try:
         new_brand = sanitize_str(new_brand)
     except ValueError:
-        bot_output(log_file, "The brand name can't be blank!")
-        return prompt_new_brand # Next action: Repeat question
+        bot_output(session, "The brand name can't be blank!")
+        return State('prompt_new_brand') # Next action: Repeat question
 
     # Check for none answer
     if is_no_answer(new_brand):
-        return ask_brands
+        return State('ask_brands')
 
     # Check if we already know this brand
-    brands_list = get_brands(brands_file)
-    if blandify_str(new_brand) in [blandify_str(b) for b in brands_list]:
-        bot_output(log_file, "I already know this brand!")
-        return prompt_new_brand
-    else: # Add brand
-        with open(brands_file, 'a') as f:
-            f.write(new_brand + '\n')
-        bot_output(log_file, f"Added brand {new_brand} to brans database in {brands_file}.")
-        return ask_brands
-
-
-
-def check_for_correction(trucks_info, input_str):
-    "If input is either 'start over' or 'correct <brand>', reset and return respective function. Otherwise return False."
-    if(blandify_str(input_str) == 'start over'):
+    if not brand_catalog.add_if_absent(new_brand): # Checked and added in one step, so two sessions can't both add it
+        bot_output(session, "I already know this brand!")
+        return State('prompt_new_brand')
+    else:
+        bot_output(session, f"Added brand {new_brand} to brans database in {brands_file}.")
+        return State('ask_brands')
+
+def check_for_correction(session, input_str):
+    "If input is either 'start over' or 'correct <brand>', reset and return respective state. Otherwise return False."
+    trucks_info = session.trucks_info
+    input_bland = as_utterance(input_str).bland
+    if(input_bland == 'start over'):
         # Reset
         trucks_info.start_over()
-        return ask_trucks_start
+        return State('ask_trucks_start')
 
-    if(blandify_str(input_str).startswith('correct ')):
+    if(input_bland.startswith('correct ')):
         for i, b in enumerate(trucks_info.brands_list):
-            if blandify_str(input_str)[8:] == blandify_str(b):
+            if input_bland[8:] == blandify_str(b):
                 # Reset
                 trucks_info.start_over_brand(i)
-                return make_ask_brand_trucks(trucks_info, i)
-        bot_output(log_file, "I did not recognize the brand you want to correct.")
+                return State('ask_brand_trucks', i)
+        bot_output(session, "I did not recognize the brand you want to correct.")
         return False
     return False
 
-def ask_trucks_start(trucks_info):
+def enter_trucks_start(session):
     'Starts asking about trucks'
-    bot_output(log_file, f"I will now ask you about your trucks. If you want to start over from here, tell me to 'start over'")
+    bot_output(session, f"I will now ask you about your trucks. If you want to start over from here, tell me to 'start over'")
 
     # (Re)set members
-    trucks_info.start_over()
-
-    return make_ask_brand_trucks(trucks_info, 0) # Next action: Ask about first truck brand
+    session.trucks_info.start_over()
 
-def make_ask_brand_trucks(trucks_info, i_brand):
-    "Makes function for asking about i_brand-th brand"
-    def ask_brand_trucks(trucks_info):
-        'Asks about i_brand-th brand'
-        brand = trucks_info.brands_list[i_brand]
+    return State('ask_brand_trucks', 0) # Next action: Ask about first truck brand
 
-        # (Re)set members
-        trucks_info.start_over_brand(i_brand)
+def enter_brand_trucks(session):
+    'Starts asking about i_brand-th brand'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
 
-        bot_output(log_file, f"I will now ask you about your {brand} trucks. If you want to correct your input for your {brand} trucks, tell me 'correct {brand}'")
+    if(i_brand >= len(trucks_info.brands_list)): # We asked about all brands already
+        bot_output(session, 'Looks like I have all the info I need. Bye!')
+        return done # We are done
 
-        if(len(trucks_info.brands_list) == 1): # We don't need to ask if we only have one brand
-            if trucks_info.n_trucks > 1:
-                bot_output(log_file, f"It seems that all your {trucks_info.n_trucks} trucks are {brand} trucks.")
-            trucks_info.n_trucks_brand[i_brand] = trucks_info.n_trucks
-        else:
-            trucks_brand = bot_input(log_file, f"How many {brand} trucks do you have? ")
+    if(check_completeness(trucks_info, i_brand)): # We already have info for this brand
+        if not trucks_info.brand_same_model[i_brand] and len(trucks_info.brand_models[i_brand]) == 1: # Notify user and change brand_same_model if user changed his mind
+            bot_output(session, f"Before you told me you have more than one model. No problem, it's ok to change your mind.")
+            trucks_info.brand_same_model[i_brand] = True
+        return State('ask_brand_trucks', i_brand+1)  # Next action: Ask about next brand
 
-            # Jump back if requested
-            correction_maybe = check_for_correction(trucks_info, trucks_brand)
-            if correction_maybe:
-                return correction_maybe
+    brand = trucks_info.brands_list[i_brand]
 
-            # Sanitizing for integer input (Number of trucks per brand)
-            try:
-                trucks_info.n_trucks_brand[i_brand] = sanitize_int(trucks_brand)
-            except ValueError:
-                #trucks_info.n_trucks_brand[i_brand] = None
-                bot_output(log_file, "That does not look like a number to me. Let's try again.")
-                return make_ask_brand_trucks(trucks_info, i_brand) # Next action: Ask again
+    # (Re)set members
+    trucks_info.start_over_brand(i_brand)
 
-            if not check_consistency(trucks_info):
-                trucks_info.n_trucks_brand[i_brand] = None
-                bot_output(log_file, f"The numbers don't seem to add up. Let me ask you again about the {brand} trucks you have.")
-                return make_ask_brand_trucks(trucks_info, i_brand) # Next action: Ask again
+    bot_output(session, f"I will now ask you about your {brand} trucks. If you want to correct your input for your {brand} trucks, tell me 'correct {brand}'")
 
-        return make_ask_same_model(trucks_info, i_brand) # Next action: Ask about models for that brand
+    if(len(trucks_info.brands_list) == 1): # We don't need to ask if we only have one brand
+        if trucks_info.n_trucks > 1:
+            bot_output(session, f"It seems that all your {trucks_info.n_trucks} trucks are {brand} trucks.")
+        trucks_info.set_brand_trucks(i_brand, trucks_info.n_trucks)
+        return State('ask_same_model', i_brand) # Next action: Ask about models for that brand
+    return None # Ask how many trucks of that brand
 
-    if(i_brand >= len(trucks_info.brands_list)): # We asked about all brands already
-        bot_output(log_file, 'Looks like I have all the info I need. Bye!')
-        return None # We are done
+def prompt_brand_trucks(session):
+    return f"How many {session.trucks_info.brands_list[session.state.i_brand]} trucks do you have? "
 
-    if(check_completeness(trucks_info, i_brand)): # We already have info for this brand
-        if not trucks_info.brand_same_model[i_brand] and len(trucks_info.brand_models[i_brand]) == 1: # Notify user and change brand_same_model if user changed his mind
-            bot_output(log_file, f"Before you told me you have more than one model. No problem, it's ok to change your mind.")
-            trucks_info.brand_same_model[i_brand] = True
-        return make_ask_brand_trucks(trucks_info, i_brand+1)  # Next action: Ask about next brand
-    
-    return ask_brand_trucks
+def answer_brand_trucks(session, trucks_brand):
+    'Handles number of trucks of i_brand-th brand'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
+    brand = trucks_info.brands_list[i_brand]
 
-def make_ask_same_model(trucks_info, i_brand):
-    'Makes function for asking about models of i_brand-th brand'
-    def ask_same_model(trucks_info):
-        'Asks about models for i_brand-th brand'
-        brand = trucks_info.brands_list[i_brand]
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, trucks_brand)
+    if correction_maybe:
+        return correction_maybe
 
-        if trucks_info.n_trucks_brand[i_brand] != 1: # If there is more than one truck, ask if they are all the same model
-            same_model_yes_no = bot_input(log_file, f"Are your {brand} trucks of the same model? ")
+    # Sanitizing for integer input (Number of trucks per brand)
+    try:
+        trucks_info.set_brand_trucks(i_brand, sanitize_int(trucks_brand))
+    except ValueError:
+        bot_output(session, "That does not look like a number to me. Let's try again.")
+        return State('ask_brand_trucks', i_brand) # Next action: Ask again
+
+    if not check_consistency(session):
+        trucks_info.set_brand_trucks(i_brand, None)
+        bot_output(session, f"The numbers don't seem to add up. Let me ask you again about the {brand} trucks you have.")
+        return State('ask_brand_trucks', i_brand) # Next action: Ask again
+
+    return State('ask_same_model', i_brand) # Next action: Ask about models for that brand
+
+def enter_same_model(session):
+    'Skips the question if there is only one truck for i_brand-th brand'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
+    if trucks_info.n_trucks_brand[i_brand] != 1: # If there is more than one truck, ask if they are all the same model
+        return None
+    # For this brand there is only one truck and one truck model
+    trucks_info.brand_same_model[i_brand] = True
+    return State('ask_brand_models', i_brand) # Next action: Ask about models for that brand
+
+def prompt_same_model(session):
+    return f"Are your {session.trucks_info.brands_list[session.state.i_brand]} trucks of the same model? "
+
+def answer_same_model(session, same_model_yes_no):
+    'Handles whether all trucks of i_brand-th brand are the same model'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
 
-            # Jump back if requested
-            correction_maybe = check_for_correction(trucks_info, same_model_yes_no)
-            if correction_maybe:
-                return correction_maybe
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, same_model_yes_no)
+    if correction_maybe:
+        return correction_maybe
 
-            if is_yes_answer(same_model_yes_no): # Only one model for this brand
-                trucks_info.brand_same_model[i_brand] = True
-                return ask_brand_models(trucks_info, i_brand) # Next action: Ask about models for that brand
-            elif is_no_answer(same_model_yes_no): # More than one model for this brand
-                trucks_info.brand_same_model[i_brand] = False
-                return ask_brand_models(trucks_info, i_brand) # Next action: Ask about models for that brand
-            else:
-                bot_output(log_file, "I am not sure I understood you. Let's try again.")
-                return make_ask_same_model(trucks_info, i_brand) # Next action: Try again
-        else: # For this brand there is only one truck and one truck model
-            trucks_info.brand_same_model[i_brand] = True
-            return ask_brand_models(trucks_info, i_brand) # Next action: Ask about models for that brand
-    
-    return ask_same_model
+    if is_yes_answer(same_model_yes_no): # Only one model for this brand
+        trucks_info.brand_same_model[i_brand] = True
+        return State('ask_brand_models', i_brand) # Next action: Ask about models for that brand
+    elif is_no_answer(same_model_yes_no): # More than one model for this brand
+        trucks_info.brand_same_model[i_brand] = False
+        return State('ask_brand_models', i_brand) # Next action: Ask about models for that brand
+    else:
+        bot_output(session, "I am not sure I understood you. Let's try again.")
+        return State('ask_same_model', i_brand) # Next action: Try again
 
-def ask_brand_models(trucks_info, i_brand):
-    'Asks about the model for a brand'
+def prompt_brand_models(session):
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
     brand = trucks_info.brands_list[i_brand]
     if trucks_info.brand_same_model[i_brand]: # Only one model
-        next_model = bot_input(log_file, f"What is the model of your {brand} trucks? ")
-        try:
-            next_model = sanitize_str(next_model)
-        except ValueError:
-            bot_output(log_file, "The model name can't be blank!")
-            return ask_brand_models(trucks_info, i_brand)
+        return f"What is the model of your {brand} trucks? "
+    return f"What is model #{len(trucks_info.brand_models[i_brand])+1} among your {brand} trucks (Answer none if you have no more models)? "
+
+def answer_brand_models(session, next_model_answer):
+    'Handles the model for a brand'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
+    brand = trucks_info.brands_list[i_brand]
+    try:
+        next_model = sanitize_str(next_model_answer)
+    except ValueError:
+        bot_output(session, "The model name can't be blank!")
+        return State('ask_brand_models', i_brand)
+    if not trucks_info.brand_same_model[i_brand] and next_model in trucks_info.brand_models[i_brand]: # Model was already given before
+        bot_output(session, f"It looks like you already told me about your {brand} {next_model} model trucks! Let's try again.")
+        return State('ask_brand_models', i_brand)
 
-    else: # More than one model
-        next_model = bot_input(log_file, f"What is model #{len(trucks_info.brand_models[i_brand])+1} among your {brand} trucks (Answer none if you have no more models)? ")
-        try:
-            next_model = sanitize_str(next_model)
-        except ValueError:
-            bot_output(log_file, "The model name can't be blank!")
-            return ask_brand_models(trucks_info, i_brand)
-        if next_model in trucks_info.brand_models[i_brand]: # Model was already given before
-            bot_output(log_file, f"It looks like you already told me about your {brand} {next_model} model trucks! Let's try again.")
-            return ask_brand_models(trucks_info, i_brand)
-    
     # Jump back if requested
-    correction_maybe = check_for_correction(trucks_info, next_model)
+    correction_maybe = check_for_correction(session, next_model_answer)
     if correction_maybe:
         return correction_maybe
 
     if not trucks_info.brand_same_model[i_brand] and is_no_answer(next_model): # User give 'none' answer - only allowed if more than one model
-        if check_consistency(trucks_info): # Check for consistency
+        if check_consistency(session): # Check for consistency
             if check_completeness(trucks_info, i_brand): # Check if we have all the trucks for this brand
                 if len(trucks_info.brand_models[i_brand]) == 1: # We are fine, but notify user and change brand_same_model if user changed his mind
-                    bot_output(log_file, f"Before you told me you have more than one model. No problem, it's ok to change your mind.")
+                    bot_output(session, f"Before you told me you have more than one model. No problem, it's ok to change your mind.")
                     trucks_info.brand_same_model[i_brand] = True
-                return make_ask_brand_trucks(trucks_info, i_brand+1) # Next action: Ask about next brand
+                return State('ask_brand_trucks', i_brand+1) # Next action: Ask about next brand
             else: # We are consistent, but there are still trucks outstanding
-                bot_output(log_file, f"We are missing information for brand {trucks_info.brands_list[i_brand]}!")
+                bot_output(session, f"We are missing information for brand {trucks_info.brands_list[i_brand]}!")
         # We are inconsistent or incomplete (or both)
-        bot_output(log_file, "The numbers don't add up. Let's try again.")
-        return ask_brand_models(trucks_info, i_brand) # Next action: Repeat this one
-    
+        bot_output(session, "The numbers don't add up. Let's try again.")
+        return State('ask_brand_models', i_brand) # Next action: Repeat this one
+
     trucks_info.brand_models[i_brand].append(next_model)            # Add model to list of models for next prompt
-    return ask_model_details(trucks_info, i_brand, next_model)      # Next action: Ask about model details
 
-def ask_model_details(trucks_info, i_brand, model_name):
-    'Asks about model details for the model named model_name of the i_brand-th brand.'
+    # Start collecting details about the model
     truck_spec = TruckSpec()
-    truck_spec.brand = trucks_info.brands_list[i_brand]
-    truck_spec.model = model_name
+    truck_spec.brand = brand
+    truck_spec.model = next_model
     truck_spec.brand_idx = i_brand
-    
-    def ask_model_engine_size():
-        'Asks about engine size'
-        engine_size_input = bot_input(log_file, f"What is the engine size for the {model_name} model [default unit: litres]? ")
-
-        # Jump back if requested
-        correction_maybe = check_for_correction(trucks_info, engine_size_input)
-        if correction_maybe:
-            return correction_maybe
-
-        # Looking for a float with optional unit - either litres or cubic centimeters
-        pat = re.compile(r"^(.*?)(l|litres|liters|litre|cc|cm³)?\s*$")
-        match = pat.match(engine_size_input)
-        if match is None:
-            bot_output(log_file, "Engine size must given as number with optional unit - either cc or litres")
-            return ask_model_engine_size
-        
-        try:
-            engine_size = sanitize_float(match.group(1))
-        except ValueError:
-            bot_output(log_file, "That does not look like a number to me. Let's try again.")
-            return ask_model_engine_size # Next action: ask again about engine size
+    session.truck_spec = truck_spec
+    return State('ask_model_details', i_brand, next_model, 'engine_size') # Next action: Ask about model details
 
-        # Convert if necessary
-        conversion_factor = 0.001 if match.group(2) in ["cc", "cm³"] else 1
-        engine_size = engine_size * conversion_factor
+# Sub-steps of asking about model details, in order
 
-        if engine_size < 1 or engine_size > 20:
-            bot_output(log_file, "Engine size seems to be too high or low, please check!")
-            return ask_model_engine_size # Next action: ask again about engine size
+def prompt_model_engine_size(session):
+    return f"What is the engine size for the {session.state.model_name} model [default unit: litres]? "
 
-        truck_spec.engine_size = engine_size
-        return None # Next action: Done asking about this.
+def answer_model_engine_size(session, engine_size_input):
+    'Handles engine size'
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, engine_size_input)
+    if correction_maybe:
+        return correction_maybe
 
-    def ask_model_axle_number():
-        'Ask about number of axles'
-        axle_numer_input = bot_input(log_file, f"How many axles does the {model_name} model have? ")
+    # A number with optional unit, e.g. litres or cubic centimeters
+    try:
+        session.truck_spec.engine_size = parse_quantity('engine_size', engine_size_input)
+    except QuantityError as e:
+        bot_output(session, e.message)
+        return session.state # Next action: ask again about engine size
 
-        # Jump back if requested
-        correction_maybe = check_for_correction(trucks_info, axle_numer_input)
-        if correction_maybe:
-            return correction_maybe
+    return session.state._replace(sub_step='axle_number') # Next action: Ask about number of axles
 
-        try:
-            axle_number = sanitize_int(axle_numer_input)
-        except ValueError:
-            bot_output(log_file, "That does not look like a number to me. Let's try again.")
-            return ask_model_axle_number # Next action: ask again about number of axles
-        
-        if axle_number < 1 or axle_number > 6:
-            bot_output(log_file, "Number of axles seems to be too high or low, please check!")
-            return ask_model_axle_number # Next action: ask again about number of axles
-        else:
-            truck_spec.axle_number = axle_number
-            return None # Next action: Done
+def prompt_model_axle_number(session):
+    return f"How many axles does the {session.state.model_name} model have? "
 
-    def ask_model_weight():
-        'Ask about weight'
-        weight_input = bot_input(log_file, f"How much does the {model_name} weigh (in tons)? ")
+def answer_model_axle_number(session, axle_numer_input):
+    'Handles number of axles'
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, axle_numer_input)
+    if correction_maybe:
+        return correction_maybe
 
-        # Jump back if requested
-        correction_maybe = check_for_correction(trucks_info, weight_input)
-        if correction_maybe:
-            return correction_maybe
+    try:
+        axle_number = sanitize_int(axle_numer_input)
+    except ValueError:
+        bot_output(session, "That does not look like a number to me. Let's try again.")
+        return session.state # Next action: ask again about number of axles
 
-        # Looking for a float with optional unit (tons)
-        pat = re.compile(r"^(.*?)(t|ton|tons)?\s*$")
-        weight_input = pat.match(weight_input).group(1)
+    if axle_number < 1 or axle_number > 6:
+        bot_output(session, "Number of axles seems to be too high or low, please check!")
+        return session.state # Next action: ask again about number of axles
+    else:
+        session.truck_spec.axle_number = axle_number
+        return session.state._replace(sub_step='weight') # Next action: Ask about weight
 
-        try:
-            weight = sanitize_float(weight_input)
-        except ValueError:
-            bot_output(log_file, "That does not look like a number to me. Let's try again.")
-            return ask_model_weight # Next action: Ask again
-
-        if weight < 0 or weight > 80:
-            bot_output(log_file, "Weight seems to be too high or low, please check!")
-            return ask_model_weight # Nex action: Ask again
-        else:
-            truck_spec.weight = weight
-            return None # Next action: Done asking about this
+def prompt_model_weight(session):
+    return f"How much does the {session.state.model_name} weigh (in tons)? "
 
-    def ask_model_max_load():
-        'Ask about max load'
-        max_load_input = bot_input(log_file, f"What is the max load for the {model_name} model (in tons)? ")
+def answer_model_weight(session, weight_input):
+    'Handles weight'
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, weight_input)
+    if correction_maybe:
+        return correction_maybe
 
-        # Jump back if requested
-        correction_maybe = check_for_correction(trucks_info, max_load_input)
-        if correction_maybe:
-            return correction_maybe
+    # A number with optional unit, e.g. tons or kg
+    try:
+        session.truck_spec.weight = parse_quantity('weight', weight_input)
+    except QuantityError as e:
+        bot_output(session, e.message)
+        return session.state # Next action: Ask again
 
-        # Looking for a float with optional unit (tons)
-        pat = re.compile(r"^(.*?)(t|ton|tons)?\s*$")
-        max_load_input = pat.match(max_load_input).group(1)
+    return session.state._replace(sub_step='max_load') # Next action: Ask about max load
 
-        try:
-            max_load = sanitize_float(max_load_input)
-        except ValueError:
-            bot_output(log_file, "That does not look like a number to me. Let's try again.")
-            return ask_model_max_load # Next action: Ask again
-
-        if max_load < 0 or max_load > 80:
-            bot_output(log_file, "Max load seems to be too high or low, please check!")
-            return ask_model_max_load # Next action: Ask again
-        else:
-            truck_spec.max_load = max_load
-            return None # Next action: Done asking about this
+def prompt_model_max_load(session):
+    return f"What is the max load for the {session.state.model_name} model (in tons)? "
 
-    def ask_model_how_many():
-        'Record number of trucks for this model'
-        if trucks_info.brand_same_model[i_brand]: # If this is the only model, we already know this
-            trucks_info.trucks_list.append((truck_spec, trucks_info.n_trucks_brand[i_brand]))
-        else:
-            model_how_many_input = bot_input(log_file, f"How many {truck_spec.brand} {model_name} trucks do you have? ")
+def answer_model_max_load(session, max_load_input):
+    'Handles max load'
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, max_load_input)
+    if correction_maybe:
+        return correction_maybe
 
-            # Jump back if requested
-            correction_maybe = check_for_correction(trucks_info, model_how_many_input)
-            if correction_maybe:
-                return correction_maybe
+    # A number with optional unit, e.g. tons or kg
+    try:
+        session.truck_spec.max_load = parse_quantity('max_load', max_load_input)
+    except QuantityError as e:
+        bot_output(session, e.message)
+        return session.state # Next action: Ask again
+
+    return session.state._replace(sub_step='how_many') # Next action: Ask about number of trucks of this model
+
+def enter_model_how_many(session):
+    'Records number of trucks for this model if we already know it'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
+    if not trucks_info.brand_same_model[i_brand]:
+        return None # Ask how many
+    # If this is the only model, we already know this
+    trucks_info.add_model(session.truck_spec, trucks_info.n_trucks_brand[i_brand])
+    return finish_model_details(session)
+
+def prompt_model_how_many(session):
+    return f"How many {session.truck_spec.brand} {session.state.model_name} trucks do you have? "
+
+def answer_model_how_many(session, model_how_many_input):
+    'Records number of trucks for this model'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
 
-            try:
-                model_how_many = sanitize_int(model_how_many_input)
-            except ValueError:
-                bot_output(log_file, "That does not look like a number to me. Let's try again.")
-                return ask_model_how_many # Next action: Ask again
+    # Jump back if requested
+    correction_maybe = check_for_correction(session, model_how_many_input)
+    if correction_maybe:
+        return correction_maybe
 
-            # Check whether that number is logically too high
-            if model_how_many + trucks_info.completeness[i_brand] > trucks_info.n_trucks_brand[i_brand]:
-                bot_output(log_file, "That's too many, the numbers don't add up. Let's try again.")
-                return ask_model_how_many # Next action: Ask again
+    try:
+        model_how_many = sanitize_int(model_how_many_input)
+    except ValueError:
+        bot_output(session, "That does not look like a number to me. Let's try again.")
+        return session.state # Next action: Ask again
+
+    # Check whether that number is logically too high
+    if model_how_many + trucks_info.completeness[i_brand] > trucks_info.n_trucks_brand[i_brand]:
+        bot_output(session, "That's too many, the numbers don't add up. Let's try again.")
+        return session.state # Next action: Ask again
 
-            # Check whether number is postive
-            if model_how_many <= 0:
-                bot_output(log_file, "I expected a positive number of trucks. Let's try again.")
-                return ask_model_how_many # Next action: Ask again
+    # Check whether number is postive
+    if model_how_many <= 0:
+        bot_output(session, "I expected a positive number of trucks. Let's try again.")
+        return session.state # Next action: Ask again
 
-            # Check whether that number is logically too low
-            if trucks_info.brand_same_model[i_brand] and model_how_many + trucks_info.completeness[i_brand] < trucks_info.n_trucks_brand[i_brand]:
-                bot_output(log_file, "That's not enough, the numbers don't add up. Let's try again.")
-                return ask_model_how_many # Next action: Ask again
+    # Check whether that number is logically too low
+    if trucks_info.brand_same_model[i_brand] and model_how_many + trucks_info.completeness[i_brand] < trucks_info.n_trucks_brand[i_brand]:
+        bot_output(session, "That's not enough, the numbers don't add up. Let's try again.")
+        return session.state # Next action: Ask again
 
-            trucks_info.trucks_list.append((truck_spec, model_how_many))
-            trucks_info.completeness[i_brand] += model_how_many
+    trucks_info.add_model(session.truck_spec, model_how_many)
+    trucks_info.completeness[i_brand] += model_how_many
 
-            return None # Next action: Done asking about this
+    return finish_model_details(session)
 
-    # Go through the sub-questions
-    for f in [ask_model_engine_size, ask_model_axle_number, ask_model_weight, ask_model_max_load, ask_model_how_many]:
-        next_action = f()
-        while next_action:
-            next_action = next_action()
+def finish_model_details(session):
+    'Decides where to go after all details for a model are collected'
+    trucks_info = session.trucks_info
+    i_brand = session.state.i_brand
+    session.truck_spec = None
 
     if trucks_info.brand_same_model[i_brand]: # If this is the only model, we can ask about the next brand
-        return make_ask_brand_trucks(trucks_info, i_brand+1) # Next action: Ask about next models for next brand
+        return State('ask_brand_trucks', i_brand+1) # Next action: Ask about next models for next brand
     else:
         if not check_completeness(trucks_info, i_brand): # If there are still trucks left for this brand, keep asking about next model
-            return ask_brand_models(trucks_info, i_brand) # Next action: Ask about next model for same brand
+            return State('ask_brand_models', i_brand) # Next action: Ask about next model for same brand
         else:
             # No trucks left for this brand - check whether user mistakenly specified only one model in beginning
             if not trucks_info.brand_same_model[i_brand] and len(trucks_info.brand_models[i_brand]) == 1: # Notify user and change brand_same_model if user changed his mind
-                bot_output(log_file, f"Before you told me you have more than one model. No problem, it's ok to change your mind.")
+                bot_output(session, f"Before you told me you have more than one model. No problem, it's ok to change your mind.")
                 trucks_info.brand_same_model[i_brand] = True
-            return make_ask_brand_trucks(trucks_info, i_brand+1) # Next action: Ask about next models for next brand
+            return State('ask_brand_trucks', i_brand+1) # Next action: Ask about next models for next brand
 
-def check_consistency(trucks_info):
+def check_consistency(session):
     'This function checks for consistency while the data is collected. As soon as an inconsistency arises during the process, this function will return False.'
+    trucks_info = session.trucks_info
 
-    # Count whether total number of trucks matches sum of number of trucks per brand
-    s = 0
-    outstanding_brands = 0 # Brand for which we have no information yet
-    for i_brand, n in enumerate(trucks_info.n_trucks_brand):
-        if n is not None:
-            if n < 1:
-                bot_output(log_file, f"The number of {trucks_info.brands_list[i_brand]} trucks is zero or negative!")
-                return False
-            s += n
-        else:
-            outstanding_brands += 1
-        if s > trucks_info.n_trucks - outstanding_brands:
-            bot_output(log_file, "The total for the number of trucks among brands exceeds the total!")
-            return False
-
-    # Count whether we have specified enough trucks
-    if outstanding_brands == 0 and s < trucks_info.n_trucks:
-        bot_output(log_file, "You have specfied too low a number of trucks!")
+    # Check whether total number of trucks matches sum of number of trucks per brand (brands we don't know about yet have at least one truck)
+    if trucks_info.n_brands_non_positive:
+        i_brand = next(i for i, n in enumerate(trucks_info.n_trucks_brand) if n is not None and n < 1)
+        bot_output(session, f"The number of {trucks_info.brands_list[i_brand]} trucks is zero or negative!")
+        return False
+    if trucks_info.n_trucks_known > trucks_info.n_trucks - trucks_info.n_brands_outstanding:
+        bot_output(session, "The total for the number of trucks among brands exceeds the total!")
+        return False
+
+    # Check whether we have specified enough trucks
+    if trucks_info.n_brands_outstanding == 0 and trucks_info.n_trucks_known < trucks_info.n_trucks:
+        bot_output(session, "You have specfied too low a number of trucks!")
         return False
 
-    # Count whether number of trucks per model matches number of trucks per brand
-    s = [0] * len(trucks_info.brands_list)
-    for model, n in trucks_info.trucks_list:
-        s[model.brand_idx] += n
-        if s[model.brand_idx] > trucks_info.n_trucks_brand[model.brand_idx]:
-            bot_output(log_file, f"The total for the number of {model.brand} trucks among models exceeds the total!")
-            return False
-    return True    
+    # Check whether number of trucks per model matches number of trucks per brand
+    if trucks_info.n_brands_overfull:
+        i_brand = next(i for i in range(len(trucks_info.brands_list)) if trucks_info.is_overfull(i))
+        bot_output(session, f"The total for the number of {trucks_info.brands_list[i_brand]} trucks among models exceeds the total!")
+        return False
+    return True
 
 def check_completeness(trucks_info, i_brand):
     ''''
@@ -594,21 +741,150 @@ def check_completeness(trucks_info, i_brand):
     else:
         return False
 
-# Initialize next_action (telling chatbot what to do next) and
-# trucks_info (holding trucks information until we write it to disk)
-next_action = ask_name
-trucks_info = TrucksInfo()
-while next_action:
-    next_action = next_action(trucks_info)
-
-bot_output(log_file, f"Saving data to {data_file}")
-bot_output(log_file, f"Saved chat log to {log_file}")
+def static_prompt(prompt_str):
+    'Makes prompt function for a question that is always asked the same way'
+    return lambda session: prompt_str
+
+# The state table: (state_id, sub_step) -> Step
+states = {
+    ('ask_name', None):                 Step(None, static_prompt("Hello, what's your name? "), answer_name),
+    ('ask_company', None):              Step(None, lambda session: f"Hi {session.trucks_info.name}, what's the name of your company? ", answer_company),
+    ('ask_trucks', None):               Step(None, static_prompt("Do you own trucks? "), answer_trucks),
+    ('ask_how_many', None):             Step(None, static_prompt("How many trucks do you have? "), answer_how_many),
+    ('ask_brands', None):               Step(None, prompt_brands, answer_brands),
+    ('ask_add_brand', None):            Step(None, static_prompt("I did not recognize any brand name. Do you want me to add a brand to the database? "), answer_add_brand),
+    ('prompt_new_brand', None):         Step(None, static_prompt("Which name should I add to the brand database? Answer 'none' if you changed your mind. "), answer_new_brand),
+    ('ask_trucks_start', None):         Step(enter_trucks_start, None, None),
+    ('ask_brand_trucks', None):         Step(enter_brand_trucks, prompt_brand_trucks, answer_brand_trucks),
+    ('ask_same_model', None):           Step(enter_same_model, prompt_same_model, answer_same_model),
+    ('ask_brand_models', None):         Step(None, prompt_brand_models, answer_brand_models),
+    ('ask_model_details', 'engine_size'): Step(None, prompt_model_engine_size, answer_model_engine_size),
+    ('ask_model_details', 'axle_number'): Step(None, prompt_model_axle_number, answer_model_axle_number),
+    ('ask_model_details', 'weight'):    Step(None, prompt_model_weight, answer_model_weight),
+    ('ask_model_details', 'max_load'):  Step(None, prompt_model_max_load, answer_model_max_load),
+    ('ask_model_details', 'how_many'):  Step(enter_model_how_many, prompt_model_how_many, answer_model_how_many),
+}
+
+def advance(session, state):
+    'Moves the session to state and on through all states that have nothing to ask, until the next question or until we are done'
+    while True:
+        session.state = state
+        if state == done:
+            return
+        step = states[state.state_id, state.sub_step]
+        if step.enter is None:
+            return
+        next_state = step.enter(session)
+        if next_state is None: # There is a question to ask
+            return
+        state = next_state
+
+# CHECKPOINTS
+# Before every question the session is saved to a checkpoint, named after the chat log. A session that was cut
+# off (the worker restarted, the connection dropped) is resumed from its checkpoint by asking that question again.
+
+checkpoint_dir = 'checkpoints' # Where to keep checkpoints of unfinished sessions
+
+def checkpoint_file(session_id):
+    'Returns the checkpoint file of a session'
+    return os.path.join(checkpoint_dir, os.path.basename(session_id) + '.json')
+
+def save_checkpoint(session):
+    'Saves the session, so that it can be resumed where it is now'
+    checkpoint = {
+        'log_file': session.log_file,
+        'state': list(session.state),
+        'trucks_info': session.trucks_info.to_checkpoint(),
+        'truck_spec': session.truck_spec.to_dict() if session.truck_spec is not None else None,
+    }
+    file_name = checkpoint_file(session.log_file)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    write_atomic(file_name, json.dumps(checkpoint))
+
+def remove_checkpoint(session):
+    'Removes the checkpoint of a finished session'
+    try:
+        os.remove(checkpoint_file(session.log_file))
+    except FileNotFoundError:
+        pass
+
+def load_session(session_id, channel):
+    'Resumes a session from its checkpoint. Raises FileNotFoundError if there is no checkpoint for session_id.'
+    with open(checkpoint_file(session_id)) as f:
+        checkpoint = json.load(f)
+    session = Session(channel, checkpoint['log_file'])
+    session.state = State(*checkpoint['state'])
+    session.trucks_info = TrucksInfo.from_checkpoint(checkpoint['trucks_info'])
+    if checkpoint['truck_spec'] is not None:
+        session.truck_spec = TruckSpec.from_dict(checkpoint['truck_spec'])
+    return session
+
+async def run_session(session, data_store=None, checkpoint=True):
+    'Runs a chat session from where it is (the start for a new session) to the end and saves the collected data to data_store (default: a store opened on data_file for this session)'
+    if session.state is None:
+        advance(session, State('ask_name'))
+    while session.state != done:
+        if checkpoint:
+            start = time.perf_counter() if metrics.enabled else None
+            save_checkpoint(session)
+            if start is not None:
+                metrics.observe('checkpoint_write', time.perf_counter() - start)
+        state = session.state
+        step = states[state.state_id, state.sub_step]
+        start = time.perf_counter() if metrics.enabled else None
+        answer = await bot_input(session, step.prompt(session))
+        answered = time.perf_counter() if start is not None else None
+        next_state = step.answer(session, answer)
+        if asyncio.iscoroutine(next_state): # Answers that wait for something, like brand matching in a worker process
+            next_state = await next_state
+        advance(session, next_state)
+        if start is not None: # Time waiting for the user and time handling the answer, up to the next question, go to separate metrics
+            metrics.observe('user_wait', answered - start)
+            metrics.observe('state', time.perf_counter() - answered, state=state.state_id if state.sub_step is None else f'{state.state_id}.{state.sub_step}')
+
+    opened = data_store is None # A store we open here is ours to close
+    if opened:
+        data_store = open_store(data_file)
+    try:
+        bot_output(session, f"Saving data to {data_store.path}")
+        bot_output(session, f"Saved chat log to {session.log_file}")
+        get_logger(session.log_file).close()
+
+        # Write info to the data store
+        start = time.perf_counter() if metrics.enabled else None
+        committed = data_store.write_session(session.trucks_info)
+        if committed is not None: # A GroupWriter, keep the checkpoint until the data is on disk
+            await asyncio.wrap_future(committed)
+        if start is not None:
+            metrics.observe('data_write', time.perf_counter() - start)
+    finally:
+        if opened:
+            data_store.close()
+    if checkpoint:
+        remove_checkpoint(session)
+
+def main():
+    'Runs a single chat session on the console'
+    parser = argparse.ArgumentParser(description='Chat about your trucks on the console')
+    parser.add_argument('--resume', metavar='SESSION_ID', help='Resume the unfinished session with this id (the name of its chat log)')
+    parser.add_argument('--data-file', default=data_file, help='Where to store the collected data, either .jsonl or a sqlite database (.db)')
+    parser.add_argument('--metrics', metavar='FILE', help='Collect timings and counters and write them to FILE (.json, else Prometheus text format)')
+    args = parser.parse_args()
+    if args.metrics is not None:
+        metrics.start_exporter(args.metrics)
+    data_store = open_store(args.data_file)
+
+    if args.resume is not None:
+        session = load_session(args.resume, ConsoleChannel())
+    else:
+        session = Session(ConsoleChannel())
+    asyncio.run(run_session(session, data_store))
+    data_store.close()
 
-# Write info to file
-with open(data_file, 'a') as f:
-    f.write(trucks_info.to_json() + '\n')
+    # Print summary info to console
+    print("\n")
+    session.trucks_info.pretty_print()
+    print("\n")
 
-# Print summary info to console
-print("\n")
-trucks_info.pretty_print()
-print("\n")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# This file serves many chat sessions from one process, over a line-based TCP or Unix socket protocol
+
+import argparse
+import asyncio
+import functools
+
+import metrics
+import run
+from brand_matcher import BrandMatcher
+from data_store import open_store
+from group_writer import GroupWriter, fsync_policies
+from run import data_file, Session, StreamChannel, load_session, run_session
+from session_log import get_logger
+
+async def open_session(reader, writer):
+    "Reads the client's first line, 'NEW' or 'RESUME <session id>', and returns the session to run, or None if it can't be opened"
+    line = await reader.readline()
+    if not line: # Connection closed
+        return None
+    request = line.decode().split()
+    channel = StreamChannel(reader, writer)
+    if request == ['NEW']:
+        session = Session(channel)
+    elif len(request) == 2 and request[0] == 'RESUME':
+        try:
+            session = load_session(request[1], channel)
+        except FileNotFoundError:
+            writer.write(f'ERROR unknown session {request[1]}\n'.encode())
+            return None
+    else:
+        writer.write(b"ERROR expected 'NEW' or 'RESUME <session id>'\n")
+        return None
+    writer.write(f'SESSION {session.log_file}\n'.encode())
+    return session
+
+async def handle_connection(data_store, reader, writer):
+    'Runs a chat session for a new connection'
+    session = None
+    try:
+        session = await open_session(reader, writer)
+        if session is not None:
+            await run_session(session, data_store)
+        await writer.drain()
+    except (EOFError, ConnectionError): # User left before we were done, the session can be resumed from its checkpoint
+        if session is not None:
+            get_logger(session.log_file).close()
+    finally:
+        writer.close()
+
+async def serve(host, port, unix_socket=None, data_store=None):
+    'Accepts connections until cancelled. All sessions save their data to data_store (default: data_file).'
+    if data_store is None:
+        data_store = open_store(data_file)
+    handler = functools.partial(handle_connection, data_store)
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve chat sessions, one per connection. The client starts with 'NEW' or 'RESUME <session id>', then every line sent by the bot is a message, every line received an answer.")
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8023, help='TCP port to listen on')
+    parser.add_argument('--unix-socket', help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--data-file', default=data_file, help='Where to store the collected data, either .jsonl or a sqlite database (.db)')
+    parser.add_argument('--fsync', choices=fsync_policies, default='always', help='When to sync the collected data to disk: after every group of sessions, at most every second, or when the OS decides (default: always)')
+    parser.add_argument('--match-workers', type=int, metavar='N', help='Match brands in N worker processes sharing the catalog, so that long answers against a large catalog do not hold up other sessions')
+    parser.add_argument('--metrics', metavar='FILE', help=f'Collect timings and counters and write them to FILE every {metrics.export_interval:g} seconds (.json, else Prometheus text format)')
+    args = parser.parse_args()
+    if args.metrics is not None:
+        metrics.start_exporter(args.metrics)
+    data_store = GroupWriter(open_store(args.data_file, args.fsync), fsync=args.fsync) # Sessions finishing at the same time share a write and fsync
+    if args.match_workers:
+        run.brand_matcher = BrandMatcher(run.brand_catalog, args.match_workers)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix_socket, data_store))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        data_store.close()
+        if run.brand_matcher is not None:
+            run.brand_matcher.close()
+
+if __name__ == '__main__':
+    main()
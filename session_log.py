@@ -0,0 +1,107 @@
+# This file buffers chat logs in memory and writes them out in batches
+
+import atexit
+import signal
+import sys
+import threading
+import time
+
+import metrics
+
+max_buffer_lines = 64   # Flush when this many lines are waiting
+flush_interval = 5.0    # Flush when the oldest waiting line is older than this (seconds)
+
+class SessionLogger:
+    'Collects log lines of a chat session and appends them to the log file in batches instead of line by line'
+    def __init__(self, log_file, max_lines=max_buffer_lines, interval=flush_interval, background=False):
+        self.log_file = log_file
+        self.max_lines = max_lines
+        self.interval = interval
+        self.buffer = []                # Lines not written yet                 List[String]
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.closed = False
+
+        # Optional writer thread, so that flushes due to time also happen while we wait for user input
+        self.wake_up = None
+        self.writer = None
+        if background:
+            self.wake_up = threading.Event()
+            self.writer = threading.Thread(target=self.run_writer, name=f'log writer {log_file}', daemon=True)
+            self.writer.start()
+
+        open_loggers.add(self)
+        install_signal_handlers()
+
+    def write(self, line):
+        'Adds a line to the log'
+        with self.lock:
+            self.buffer.append(line + '\n')
+            full = len(self.buffer) >= self.max_lines
+        if self.writer is not None:
+            if full:
+                self.wake_up.set()
+        elif full or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        'Writes all waiting lines to the log file'
+        with self.lock:
+            if self.buffer:
+                start = time.perf_counter() if metrics.enabled else None
+                with open(self.log_file, 'a') as f:
+                    f.write(''.join(self.buffer))
+                self.buffer = []
+                if start is not None:
+                    metrics.observe('log_write', time.perf_counter() - start)
+            self.last_flush = time.monotonic()
+
+    def run_writer(self):
+        'Loop of the writer thread'
+        while not self.closed:
+            self.wake_up.wait(self.interval)
+            self.wake_up.clear()
+            self.flush()
+
+    def close(self):
+        'Flushes the log and stops the writer thread'
+        self.closed = True
+        if self.writer is not None:
+            self.wake_up.set()
+            self.writer.join()
+        self.flush()
+        open_loggers.discard(self)
+        if loggers.get(self.log_file) is self: # Finished sessions must not pile up in a long-running server
+            del loggers[self.log_file]
+
+# All loggers that still need to be flushed when we exit. Loggers leave both collections when they are closed.
+open_loggers = set()
+
+# Open loggers by log file, so that the bot can keep passing around file names
+loggers = dict()
+
+def get_logger(log_file, **kwargs):
+    'Returns the logger for log_file, creating it if needed'
+    logger = loggers.get(log_file)
+    if logger is None or logger.closed:
+        logger = loggers[log_file] = SessionLogger(log_file, **kwargs)
+    return logger
+
+@atexit.register
+def flush_all():
+    'Flushes all open loggers. Runs on exit, also after an uncaught exception.'
+    for logger in list(open_loggers):
+        logger.close()
+
+signal_handlers_installed = False
+
+def install_signal_handlers():
+    'Makes termination signals exit normally, so that atexit flushes the logs'
+    global signal_handlers_installed
+    if signal_handlers_installed or threading.current_thread() is not threading.main_thread():
+        return
+    signal_handlers_installed = True
+    for name in ['SIGTERM', 'SIGHUP']:
+        signum = getattr(signal, name, None)
+        if signum is not None and signal.getsignal(signum) == signal.SIG_DFL: # Don't replace handlers set up by someone else
+            signal.signal(signum, lambda signum, frame: sys.exit(128 + signum))
@@ -0,0 +1,91 @@
+# Tests of the compiled brand index file, run with: python -m pytest
+
+import os
+import random
+
+import pytest
+
+import brand_catalog
+import brand_index_file
+import trucks_nlp
+from brand_catalog import BrandCatalog
+from brand_index_file import MappedBrandIndex, compile_index, index_file, load_index, source_hash
+from trucks_nlp import BrandIndex, blandify_str, find_brand, get_brands
+
+syllables = ['ka', 'ro', 'mi', 'te', 'lu', 'sa', 'vo', 'ne', 'di', 'gra', 'tor', 'vex', 'lan', 'bri', 'sco', 'mer', 'dal', 'zen']
+
+def catalog(rng, size):
+    'The real brands, made up ones, and brands whose bland forms collide'
+    brands = get_brands(os.path.join(os.path.dirname(__file__), 'brands.txt'))
+    while len(brands) < size:
+        name = ''.join(rng.choice(syllables) for i in range(rng.randint(1, 5))).capitalize()
+        brands.append(name + ' ' + rng.choice(['Trucks', 'Motors', str(rng.randint(1, 99))]) if rng.random() < 0.2 else name)
+    return brands + ['Volvo', 'VOLVO!', 'Mérzen', 'merzen']
+
+def candidates(rng, brands, n):
+    'Bland strings to match: brands, brands with typos, and random ones'
+    result = []
+    for i in range(n):
+        bland = blandify_str(rng.choice(brands))
+        if i % 3 == 1 and bland:
+            pos = rng.randrange(len(bland))
+            bland = bland[:pos] + rng.choice('aeiouxz') + bland[pos+1:]
+        elif i % 3 == 2:
+            bland = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for k in range(rng.randint(1, 20))).strip()
+        result.append(bland)
+    return result
+
+@pytest.fixture
+def indexes(tmp_path):
+    'A BrandIndex and the MappedBrandIndex compiled from the same brands'
+    rng = random.Random(0)
+    brands = catalog(rng, 3000)
+    data = ('\n'.join(brands) + '\n').encode()
+    path = str(tmp_path / 'brands.txt.idx')
+    compile_index(brands, source_hash(data), path)
+    mapped = load_index(path, source_hash(data))
+    assert isinstance(mapped, MappedBrandIndex)
+    return BrandIndex(brands), mapped, brands
+
+def test_load_checks_source_hash(tmp_path):
+    path = str(tmp_path / 'brands.txt.idx')
+    compile_index(['Volvo', 'Scania'], source_hash(b'Volvo\nScania\n'), path)
+    assert load_index(path, source_hash(b'Volvo\n')) is None
+    assert load_index(str(tmp_path / 'missing.idx'), source_hash(b'')) is None
+
+def test_index_replaced_between_compile_and_load(monkeypatch, tmp_path):
+    # Another process compiles the index file of another version of the brands file right after us
+    def compile_then_replaced(brands, data_hash, path):
+        compiled = compile_index(brands, data_hash, path)
+        compile_index(['Scania'], source_hash(b'Scania\n'), path)
+        return compiled
+    monkeypatch.setattr(brand_index_file, 'compile_index', compile_then_replaced)
+    monkeypatch.setattr(brand_catalog, 'min_mapped_brands', 1)
+    brands_file = str(tmp_path / 'brands.txt')
+    with open(brands_file, 'w') as f:
+        f.write('Volvo\nScania\nMAN\n')
+    catalog = BrandCatalog(brands_file)
+    assert isinstance(catalog.index, MappedBrandIndex)
+    assert load_index(index_file(brands_file), source_hash(b'Volvo\nScania\nMAN\n')) is None
+    assert len(catalog) == 3
+    assert find_brand('a volvo and a man', catalog.index) == find_brand('a volvo and a man', BrandIndex(['Volvo', 'Scania', 'MAN']))
+
+@pytest.mark.parametrize('batch_scoring', [True, False])
+def test_round_trip_best_match(monkeypatch, indexes, batch_scoring):
+    monkeypatch.setattr(trucks_nlp, 'batch_scoring', batch_scoring and trucks_nlp.batch_scoring)
+    brand_index, mapped, brands = indexes
+    assert len(mapped) == len(brand_index)
+    assert list(mapped.brands_list) == brand_index.brands_list
+    assert list(mapped.brands_list_bland) == brand_index.brands_list_bland
+    for candidate in candidates(random.Random(1), brands, 600):
+        assert mapped.best_match(candidate) == brand_index.best_match(candidate), candidate
+
+def test_round_trip_after_add(indexes):
+    brand_index, mapped, brands = indexes
+    for brand in ['Zzyzx Heavy Haulage', 'Karomi Test', 'volvo', 'Brandnew']:
+        brand_index.add(brand)
+        mapped.add(brand)
+    for s in ['we have zzyzx heavy haulage', 'brandnew and karomi tset', 'Volvo', 'VOLVO and merzen', 'scania and man']:
+        assert find_brand(s, mapped) == find_brand(s, brand_index), s
+    for candidate in candidates(random.Random(2), brands + ['Zzyzx Heavy Haulage', 'Brandnew'], 300):
+        assert mapped.best_match(candidate) == brand_index.best_match(candidate), candidate
@@ -0,0 +1,63 @@
+# Tests of numerals.parse_number, run with: python -m pytest
+
+import pytest
+
+from numerals import parse_number
+
+numbers = [
+    ('0', 0),
+    ('zero', 0),
+    ('one', 1),
+    ('twenty five', 25),
+    ('twenty-five', 25),
+    ('fourty', 40),
+    ('a hundred', 100),
+    ('a hundred and forty', 140),
+    ('one hundred and one', 101),
+    ('eleven hundred', 1100),
+    ('nineteen hundred and ninety', 1990),
+    ('a thousand', 1000),
+    ('three thousand', 3000),
+    ('two hundred thousand', 200000),
+    ('one million two hundred thousand and five', 1200005),
+    ('a dozen', 12),
+    ('two dozen', 24),
+    ('1200', 1200),
+    ('1,200', 1200),
+    ('2.5', 2.5),
+    ('two point five', 2.5),
+    ('point five', 0.5),
+    ('two and a half', 2.5),
+    ('half', 0.5),
+    ('minus three', -3),
+    ('-3', -3),
+    ('  Twenty Five ', 25),
+]
+
+not_numbers = [
+    '',
+    'lots',
+    'oh',
+    'two oh five',
+    'and',
+    'hundred',
+    'five four',
+    'twenty twenty',
+    'zero zero',
+    'one and',
+    'thousand million',
+    'two hundred fifty hundred',
+    'point',
+    'two point fifteen',
+    '1,20',
+]
+
+@pytest.mark.parametrize('s, number', numbers)
+def test_parse_number(s, number):
+    assert parse_number(s) == number
+    assert type(parse_number(s)) is type(number)
+
+@pytest.mark.parametrize('s', not_numbers)
+def test_not_a_number(s):
+    with pytest.raises(ValueError):
+        parse_number(s)
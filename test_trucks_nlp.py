@@ -0,0 +1,52 @@
+# Tests of the batched brand scoring in trucks_nlp, run with: python -m pytest
+
+import random
+
+import pytest
+from fuzzywuzzy import fuzz
+
+import trucks_nlp
+from trucks_nlp import BrandBucket, min_fuzzy_ratio
+
+alphabet = 'abcde fgh'
+
+def mutate(rng, s):
+    'Changes, drops or inserts a few characters of s'
+    s = list(s)
+    for i in range(rng.randint(0, 3)):
+        kind, pos = rng.randrange(3), rng.randrange(len(s) + 1)
+        if kind == 0 and pos < len(s):
+            s[pos] = rng.choice(alphabet)
+        elif kind == 1 and pos < len(s) and len(s) > 1:
+            del s[pos]
+        else:
+            s.insert(pos, rng.choice(alphabet))
+    return ''.join(s)
+
+def expected_score(s, brand):
+    ratio = fuzz.ratio(s, brand)
+    return ratio if ratio > min_fuzzy_ratio else 0
+
+@pytest.mark.parametrize('batch_scoring', [True, False])
+@pytest.mark.parametrize('len_brand', [1, 4, 5, 7, 8, 15, 16, 30, 60, 250])
+def test_bucket_scores_match_fuzz_ratio(monkeypatch, batch_scoring, len_brand):
+    monkeypatch.setattr(trucks_nlp, 'batch_scoring', batch_scoring and trucks_nlp.batch_scoring)
+    rng = random.Random(len_brand)
+    bucket = BrandBucket(len_brand)
+    blands = [''.join(rng.choice(alphabet) for i in range(len_brand)) for k in range(50)]
+    for idx_brand, bland in enumerate(blands):
+        bucket.add(idx_brand, bland)
+    for k in range(200):
+        s = mutate(rng, rng.choice(blands)) if k % 4 else ''.join(rng.choice(alphabet) for i in range(rng.randint(1, 2 * len_brand + 2)))
+        assert list(bucket.scores(s)) == [expected_score(s, bland) for bland in blands], s
+
+def test_bucket_scores_after_add():
+    rng = random.Random(0)
+    bucket = BrandBucket(10)
+    blands = []
+    for k in range(20):
+        bland = ''.join(rng.choice(alphabet) for i in range(10))
+        bucket.add(k, bland)
+        blands.append(bland)
+        s = mutate(rng, bland)
+        assert list(bucket.scores(s)) == [expected_score(s, b) for b in blands]
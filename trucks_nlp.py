@@ -1,142 +1,466 @@
 # This file does some basic language stuff
 
-import inflect
-from fuzzywuzzy import fuzz
+import time
+import_started = time.perf_counter()
+
+import importlib.util
+import math
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from functools import lru_cache
+
+import metrics
+from normalize import as_utterance, blandify_str
+from numerals import parse_number
 
 # Minimum ratios for fuzzy brand matching
 min_fuzzy_ratio = 80       # 
 #min_token_sort_ratio = 100 # Should match all the tokens
 
+# Length of the character n-grams used for pruning brand candidates
+ngram_size = 2
+
+# The batch scorer computes fuzz.ratio from the longest common subsequence, which is what fuzzywuzzy does with python-Levenshtein.
+# Without it fuzzywuzzy falls back to difflib, and we have to score brand by brand.
+batch_scoring = importlib.util.find_spec('Levenshtein') is not None
+max_lane_bytes = 31 # Per-lane popcounts are summed bytewise, so they have to stay below 256
+
+# Number of brand recognition results kept across sessions
+brand_cache_size = 4096
+
+# Number of ones in every byte value
+popcount_table = bytes(bin(i).count('1') for i in range(256))
+
 # Some alternatives for yes/no answers
 yes_answers = ["yes", "y", "yep", "yup", "ya", "ja", "sure"]
 no_answers = ["no", "n", "none", "nope", "nein", "zero", "no more"]
 
 def is_yes_answer(s):
-    if s.lower() in yes_answers:
+    if as_utterance(s).lowered in yes_answers:
         return True
     return False
 
 def is_no_answer(s):
-    if s.lower() in no_answers:
+    if as_utterance(s).lowered in no_answers:
         return True
     return False
 
-# We are able to deal with some number words
-p = inflect.engine()
-number_words_dict = {
-    p.number_to_words(i):i for i in range(21)
-}
-
 def sanitize_int(n_str):
     'Try to interpret n_str as an int'
-    n_str_stripped = n_str.strip()
+    n_str_stripped = as_utterance(n_str).stripped
     try:
         n = int(n_str_stripped)
     except ValueError:
-        try:
-            n = number_words_dict[n_str_stripped]
-        except KeyError:
-            raise ValueError # Raise ValueError for our chatbot to catch
+        n = parse_number(n_str_stripped) # Number words, thousands separators. Raises ValueError for our chatbot to catch
+        if isinstance(n, float):
+            if not n.is_integer():
+                raise ValueError
+            n = int(n)
     return n
 
 def sanitize_float(x_str):
     'Try to interpret n_str as an int'
     # Could also add ability to deal with German-style floats
-    x_str_stripped = x_str.strip()
+    x_str_stripped = as_utterance(x_str).stripped
     try:
         x = float(x_str_stripped)
     except ValueError:
-        try:
-            x = number_words_dict[x_str_stripped]
-        except KeyError:
-            raise ValueError # Raise ValueError for our chatbot to catch
+        x = parse_number(x_str_stripped) # Number words, thousands separators. Raises ValueError for our chatbot to catch
     return x
 
 def sanitize_str(s_str):
     'Make sure string is not empty.'
-    s_str = s_str.strip()
+    s_str = as_utterance(s_str).stripped
     if s_str == '':
         raise ValueError # Raise ValueError for our chatbot to catch
     # Could also add ability to deal with German-style floats
     return s_str
 
-def blandify_str(s):
-    'Convert a string to lowercase and replace special characters.'
-    special_chars = '-,_.;:!"\'$%^&*()=+[]{}\\/?<>|'
-    replacement_dict = {
-        'ä':'a',
-        'ö':'o',
-        'ü':'u',
-        'ë':'e',
-        'š':'s',
-    }
-    # Convert to lower case
-    s = s.lower()
-    # Replace special characters
-    for c in special_chars:
-        s = s.replace(c, ' ')
-    for k, v in replacement_dict.items():
-        s = s.replace(k, v)
-    # Get rid of extra whitespace
-    return ' '.join(s.split()).strip()
-
 def get_brands(brands_file):
     'Reads all known brands from a file, returns a list'
     with open(brands_file, 'r') as f:
         brands_list = [ l.rstrip('\n') for l in f ]
     return brands_list
 
+def split_brands(data):
+    'Splits the content of a brands file (bytes) into brands, leaving out empty lines'
+    return [line.rstrip('\r') for line in data.decode().split('\n') if line.rstrip('\r')]
+
+@lru_cache(maxsize=None)
+def fuzz():
+    'Imports fuzzywuzzy on first use. With batch scoring, brand matching never needs it.'
+    from fuzzywuzzy import fuzz
+    return fuzz
+
 def fuzzy_match(s, brand):
     'Does fuzzy matching between string s and brand. Returns score, or -1 if no match'
-    fuzz_ratio = fuzz.ratio(s, brand)
+    if min_common_length(len(s), len(brand), min_fuzzy_ratio) is None: # Lengths too different, no need to compute the ratio
+        return -1
+    fuzz_ratio = fuzz().ratio(s, brand)
     if fuzz_ratio > min_fuzzy_ratio:
         return fuzz_ratio
     return -1
-    
-def find_brand(s, brands_list):
-    'Looks which brands in string s are found in brands_list.'
+
+def get_ngrams(s, n=ngram_size):
+    'Returns the character n-grams of s with their counts'
+    return Counter(s[k:k+n] for k in range(len(s) - n + 1))
+
+@lru_cache(maxsize=None)
+def min_common_length(len_s, len_brand, min_ratio):
+    'Shortest common subsequence two strings of the given lengths need for their fuzzy ratio to exceed min_ratio, or None if that is impossible'
+    # fuzz.ratio is 2 * LCS / (len_s + len_brand)
+    len_sum = len_s + len_brand
+    max_dist = math.ceil(len_sum * (100 - min_ratio) / 100) - 1
+    min_lcs = (len_sum - max_dist + 1) // 2
+    if max_dist < 0 or min_lcs > min(len_s, len_brand):
+        return None
+    return min_lcs
+
+@lru_cache(maxsize=None)
+def min_shared_ngrams(len_s, len_brand, min_ratio, n=ngram_size):
+    '''
+    Lower bound on the number of n-grams two strings of the given lengths share if their fuzzy ratio exceeds min_ratio.
+    Returns None if the ratio can't be exceeded at these lengths at all.
+    '''
+    min_lcs = min_common_length(len_s, len_brand, min_ratio)
+    if min_lcs is None:
+        return None
+    # Every deleted character destroys at most n n-grams, every inserted character breaks at most n-1
+    deleted, inserted = len_s - min_lcs, len_brand - min_lcs
+    return max(len_s - n + 1 - n * deleted - (n - 1) * inserted,
+               len_brand - n + 1 - n * inserted - (n - 1) * deleted)
+
+@lru_cache(maxsize=None)
+def match_length_range(len_s, min_ratio):
+    'Range of string lengths whose fuzzy ratio with a string of length len_s can exceed min_ratio'
+    lengths = [len_brand for len_brand in range(1, 2 * len_s + 2) if min_common_length(len_s, len_brand, min_ratio) is not None]
+    if not lengths:
+        return range(0)
+    return range(lengths[0], lengths[-1] + 1)
+
+@lru_cache(maxsize=None)
+def max_match_length(len_brand, min_ratio):
+    'Length of the longest string whose fuzzy ratio with a string of length len_brand can exceed min_ratio'
+    len_s = len_brand
+    while min_common_length(len_s + 1, len_brand, min_ratio) is not None:
+        len_s += 1
+    return len_s
+
+@lru_cache(maxsize=None)
+def score_table(len_s, len_brand, min_ratio):
+    '''
+    Translation table from the number of unmatched brand characters to the fuzzy_match score.
+    Scores that don't exceed min_ratio are mapped to 0.
+    '''
+    table = bytearray(256)
+    for unmatched in range(len_brand + 1):
+        lcs = len_brand - unmatched
+        len_sum = len_s + len_brand
+        ratio = int(round(100 * (1.0 - (len_sum - 2 * lcs) / len_sum))) # Same arithmetic as fuzz.ratio
+        if ratio > min_ratio:
+            table[unmatched] = ratio
+    return bytes(table)
+
+class BrandBucket:
+    '''
+    Brands of the same bland length, packed side by side into one big integer so that a string can be scored against all of them at once.
+    Every brand gets a lane of whole bytes with one bit per character plus a guard bit that stops carries into the next lane.
+    '''
+    def __init__(self, len_brand):
+        self.len_brand = len_brand
+        self.lane_bytes = len_brand // 8 + 1
+        self.brand_ids = []             # Brand indices in the BrandIndex       List[Integer]
+        self.blands = []                # Bland brands, same order              List[String]
+        self.char_masks = None          # Lanes where brand has that character  Dict[String, Integer]
+        self.ones = None                # All brand bits set                    Integer
+
+    def add(self, idx_brand, bland):
+        'Adds a brand, lanes are compiled again on next use'
+        self.brand_ids.append(idx_brand)
+        self.blands.append(bland)
+        self.char_masks = None
+
+    def compile(self):
+        'Packs the brands into lanes'
+        n_lanes, lane_bytes = len(self.blands), self.lane_bytes
+        char_lanes = defaultdict(lambda: bytearray(n_lanes * lane_bytes))
+        for k, bland in enumerate(self.blands):
+            lane = defaultdict(int)
+            for pos, c in enumerate(bland):
+                lane[c] |= 1 << pos
+            for c, mask in lane.items():
+                char_lanes[c][k*lane_bytes:(k+1)*lane_bytes] = mask.to_bytes(lane_bytes, 'little')
+        self.char_masks = {c: int.from_bytes(lanes, 'little') for c, lanes in char_lanes.items()}
+        self.ones = int.from_bytes(((1 << self.len_brand) - 1).to_bytes(lane_bytes, 'little') * n_lanes, 'little')
+
+    def unmatched_counts(self, v):
+        'Counts the ones in every lane of v, one byte per brand'
+        n_bytes, lane_bytes = len(self.blands) * self.lane_bytes, self.lane_bytes
+        unmatched = v.to_bytes(n_bytes, 'little').translate(popcount_table)
+        if lane_bytes > 1: # Sum up byte counts into the first byte of every lane
+            counts = int.from_bytes(unmatched, 'little')
+            total = counts
+            for shift in range(8, 8 * lane_bytes, 8):
+                total += counts >> shift
+            unmatched = total.to_bytes(n_bytes, 'little')[::lane_bytes]
+        return unmatched
+
+    def scores(self, s):
+        'Scores s against every brand in the bucket like fuzzy_match does. Returns one byte per brand, 0 if there is no match.'
+        min_lcs = min_common_length(len(s), self.len_brand, min_fuzzy_ratio)
+        if min_lcs is None: # Lengths too different
+            return bytes(len(self.blands))
+        if not batch_scoring or self.lane_bytes > max_lane_bytes:
+            return bytes(max(fuzzy_match(s, b), 0) for b in self.blands)
+        if self.char_masks is None:
+            self.compile()
+
+        # Bit-parallel LCS (Hyyrö): every zero bit in a lane is a brand character on the LCS with the part of s seen so far
+        ones = self.ones
+        v = ones
+        checkpoint = len(s) // 2
+        for k, c in enumerate(s):
+            u = v & self.char_masks.get(c, 0)
+            v = ((v + u) | (v - u)) & ones # Carries out of a lane end up in its guard bit and are masked away
+            if k == checkpoint:
+                # The rest of s can add at most one character per step to the LCS, stop if no brand can reach min_lcs anymore
+                best_lcs = self.len_brand - min(self.unmatched_counts(v))
+                if best_lcs + len(s) - k - 1 < min_lcs:
+                    return bytes(len(self.blands))
+
+        return self.unmatched_counts(v).translate(score_table(len(s), self.len_brand, min_fuzzy_ratio))
+
+class LRUCache:
+    'Bounded cache that evicts the least recently used entry first, with hit, miss and eviction counters'
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        'Returns the value for key, or None if it is not cached'
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        'Caches value for key, evicting the least recently used entry if the cache is full'
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        'Returns the counters as a dict'
+        return {
+            'size':len(self.entries),
+            'maxsize':self.maxsize,
+            'hits':self.hits,
+            'misses':self.misses,
+            'evictions':self.evictions,
+        }
+
+class BrandIndex:
+    'Holds the brand catalog together with its normalized forms. Built once and shared by all sessions.'
+    def __init__(self, brands_list=(), cache_size=brand_cache_size):
+        self.brands_list = []           # Brands as given in the brands file    List[String]
+        self.brands_list_bland = []     # Normalized brands, same order         List[String]
+        self.bland2brand = dict()       # For getting back from bland brand     Dict[String, String]
+        self.ngram_postings = defaultdict(list) # Brands containing n-gram  Dict[String, List[Tuple(Integer, Integer)]]
+        self.max_bland_len = 0          # Length of the longest bland brand     Integer
+        self.buckets = dict()           # Brands by bland length, for batch scoring Dict[Integer, BrandBucket]
+        self.version = 0                # Incremented whenever a brand is added Integer
+        self.cache = LRUCache(cache_size) # Brands mentioned, by version and bland input
+        for brand in brands_list:
+            self.add(brand)
+
+    @classmethod
+    def from_file(cls, brands_file):
+        'Builds the index from a brands file'
+        return cls(get_brands(brands_file))
+
+    def add(self, brand):
+        'Inserts a single brand without rebuilding the index'
+        bland = blandify_str(brand)
+        self.brands_list.append(brand)
+        self.brands_list_bland.append(bland)
+        self.bland2brand[bland] = brand # Not unique: last brand with that bland form wins
+        idx_brand = len(self.brands_list_bland) - 1
+        for gram, count in get_ngrams(bland).items():
+            self.ngram_postings[gram].append((idx_brand, count))
+        if len(bland) not in self.buckets:
+            self.buckets[len(bland)] = BrandBucket(len(bland))
+        self.buckets[len(bland)].add(idx_brand, bland)
+        self.version += 1 # Cached results from before this brand was added are not used anymore
+        self.max_bland_len = max(self.max_bland_len, len(bland))
+
+    def fuzzy_candidates(self, s):
+        '''
+        Returns the indices of all brands whose fuzzy ratio with s can exceed min_fuzzy_ratio, in catalog order.
+        Brands that are left out are guaranteed not to match, so scoring only the candidates gives the same result as scoring all brands.
+        '''
+        # Count shared n-grams per brand
+        shared = Counter()
+        for gram, count in get_ngrams(s).items():
+            for idx_brand, brand_count in self.ngram_postings.get(gram, ()):
+                shared[idx_brand] += min(count, brand_count)
+
+        candidates = set()
+        for len_brand in match_length_range(len(s), min_fuzzy_ratio):
+            bucket = self.buckets.get(len_brand)
+            if bucket is None:
+                continue
+            min_shared = min_shared_ngrams(len(s), len_brand, min_fuzzy_ratio)
+            if min_shared <= 0: # Bound is not informative for short strings, need to score the whole bucket
+                candidates.update(bucket.brand_ids)
+            else:
+                candidates.update(i for i in bucket.brand_ids if shared[i] >= min_shared)
+        return sorted(candidates)
+
+    def fuzzy_scores(self, s):
+        'Scores s against every brand in a single batched pass. Returns fuzzy_match scores in catalog order.'
+        scores = [-1] * len(self.brands_list_bland)
+        for len_brand in match_length_range(len(s), min_fuzzy_ratio):
+            bucket = self.buckets.get(len_brand)
+            if bucket is None:
+                continue
+            for idx_brand, score in zip(bucket.brand_ids, bucket.scores(s)):
+                if score > 0:
+                    scores[idx_brand] = score
+        return scores
+
+    def best_match(self, candidate):
+        'Returns the brand best matching the bland string candidate, or None if there is no match'
+        # Only do fuzzy matching if string length > 4
+        # This is to prevent mistakes e.g. for abbreviations and prevent mismatching of common short words
+        if len(candidate) <= 4: # Else do exact matching
+            brand = self.bland2brand.get(candidate)
+            if metrics.enabled and brand is not None:
+                metrics.inc('find_brand_exact_hits')
+            return brand
+
+        best_match_score = -1
+        best_match = None
+        if batch_scoring: # Score all brands of a compatible length at once
+            best_match_idx = None
+            for len_brand in match_length_range(len(candidate), min_fuzzy_ratio): # Other lengths are too different to match
+                bucket = self.buckets.get(len_brand)
+                if bucket is None:
+                    continue
+                scores = bucket.scores(candidate)
+                if metrics.enabled:
+                    metrics.inc('find_brand_fuzzy_comparisons', len(bucket.brand_ids))
+                bucket_score = max(scores)
+                if bucket_score == 0:
+                    continue
+                idx_brand = bucket.brand_ids[scores.index(bucket_score)]
+                # On equal scores the brand that comes first in the catalog wins
+                if bucket_score > best_match_score or (bucket_score == best_match_score and idx_brand < best_match_idx):
+                    best_match_score, best_match_idx = bucket_score, idx_brand
+            best_match = self.brands_list_bland[best_match_idx] if best_match_score > -1 else None
+        else: # Compare candidate to brands one by one, brands that can't match are pruned by the n-gram index
+            candidates = self.fuzzy_candidates(candidate)
+            if metrics.enabled:
+                metrics.inc('find_brand_fuzzy_comparisons', len(candidates))
+            for idx_brand in candidates:
+                b = self.brands_list_bland[idx_brand]
+                candidate_score = fuzzy_match(candidate, b)
+                if candidate_score > best_match_score:
+                    best_match = b
+                    best_match_score = candidate_score
+
+        if best_match_score > -1:
+            if metrics.enabled:
+                metrics.inc('find_brand_fuzzy_hits')
+            return self.bland2brand[best_match]
+        return None
+
+    def __contains__(self, brand):
+        return blandify_str(brand) in self.bland2brand
+
+    def __len__(self):
+        return len(self.brands_list)
+
+def find_brand(s, brand_index):
+    'Looks which brands in string s are found in brand_index (a BrandIndex or a list of brands).'
+    return list(set(find_brand_mentions(s, brand_index)))
+
+def find_brand_mentions(s, brand_index):
+    'Like find_brand, but returns the brands in the order they are mentioned in s, a brand mentioned twice twice'
+    if not isinstance(brand_index, BrandIndex):
+        brand_index = BrandIndex(brand_index)
 
     # To get around capitalization and special character issues, all comparisons are made on lowercase ascii
-    s = blandify_str(s)
-    brands_list_bland = [ blandify_str(b) for b in brands_list ]
-
-    # Dict for getting back from bland brand
-    bland2brand = dict()
-    for bland, brand in zip(brands_list_bland, brands_list): # Not using comprehension b/c bland may not be unique
-        bland2brand[bland] = brand
-
-    # Tokenize
-    s_tokenized = s.split()
-
-    def find_brand_iter(tokens):
-        # We look for largest possible group of tokens first
-        for i in range(len(tokens)):
-            for j in reversed(range(i+1, len(tokens)+1)):
-                best_match_score = -1
-                best_match = None
-                for idx_brand, b in enumerate(brands_list_bland):
-                    # Compare candidate to b using fuzzy matching
-                    candidate = ' '.join(tokens[i:j])
-                    # Only do fuzzy matching if string length > 4
-                    # This is to prevent mistakes e.g. for abbreviations and prevent mismatching of common short words
-                    if len(candidate) > 4:
-                        candidate_score = fuzzy_match(candidate, b)
-                    else: # Else do exact matching
-                        if(candidate == b):
-                            return [bland2brand[b]] + find_brand_iter(tokens[:i] + tokens[j:])
-                        else:
-                            candidate_score = -1
-
-                    if candidate_score > best_match_score:
-                        best_match = b
-                        best_match_score = candidate_score
-
-                # If we found a brand, continue searching recursively on remaining tokens
-                if best_match_score > -1:
-                    return [bland2brand[best_match]] + find_brand_iter(tokens[:i] + tokens[j:])
-    
-        # Return empty list if no match was found
-        return []
-    
-    result = find_brand_iter(s_tokenized)
-    return list(set(result))
+    utterance = as_utterance(s)
+
+    # Same answers come up again and again, so results are cached for the current version of the catalog
+    cache_key = (brand_index.version, utterance.bland)
+    cached_result = brand_index.cache.get(cache_key)
+    if metrics.enabled:
+        metrics.inc('find_brand_calls')
+        if cached_result is not None:
+            metrics.inc('find_brand_cache_hits')
+    if cached_result is not None:
+        return cached_result
+
+    tokens = list(utterance.tokens) # Copy, matched tokens are removed below
+
+    # Spans longer than this can't match any brand, so we never look at them
+    max_len = max(4, max_match_length(brand_index.max_bland_len, min_fuzzy_ratio))
+
+    # Matches for spans we already looked at, every distinct span is only scored once
+    span_matches = dict()
+    def match_span(candidate):
+        if candidate not in span_matches:
+            if metrics.enabled:
+                metrics.inc('find_brand_spans')
+            span_matches[candidate] = brand_index.best_match(candidate)
+        return span_matches[candidate]
+
+    result = []
+    i = 0
+    while i < len(tokens):
+        # We look for largest possible group of tokens starting at token i first
+        j, span_len = i + 1, len(tokens[i])
+        while j < len(tokens) and span_len + 1 + len(tokens[j]) <= max_len:
+            span_len += 1 + len(tokens[j])
+            j += 1
+        for j in reversed(range(i+1, j+1)):
+            brand = match_span(' '.join(tokens[i:j]))
+            if brand is not None:
+                break
+        else: # No match starting at token i
+            i += 1
+            continue
+
+        # Found a brand, continue searching on remaining tokens
+        result.append(brand)
+        del tokens[i:j]
+        # Spans starting a few tokens before i can now reach across the removed tokens, so we look at them again
+        span_len = -1
+        while i > 0 and span_len + 1 + len(tokens[i-1]) < max_len:
+            span_len += 1 + len(tokens[i-1])
+            i -= 1
+
+    result = tuple(result)
+    brand_index.cache.put(cache_key, result)
+    return result
+
+# Workers are started on demand, so importing this module has to stay fast
+import_time_budget = 0.1 # Seconds
+import_seconds = time.perf_counter() - import_started